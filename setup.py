@@ -30,8 +30,11 @@ setup(
         entry_points = {
             'console_scripts': [
                 'zipexplode = xzip.explode:main',
-                'zipanaylze = xzip.anaylze:main',
+                'zipimplode = xzip.implode:main',
+                'zipanalyze = xzip.analyze:main',
                 'mount.xzip = xzip.fs:main',
+                'zipverify = xzip.verify:main',
+                'zipbench = xzip.benchmarks.run:main',
             ],
         },
 
@@ -2,127 +2,370 @@
 # vim: set fileencoding=utf-8 :
 
 import csv
+import json
+import os
 import struct
 import sys
 import zlib
 
+from argparse import ArgumentParser
+from binascii import b2a_hex
 from collections import namedtuple
-from hashlib import sha1
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from os import path
 
-__all__ = ('CENTRAL_DIR', 'END_OF_DIR', 'LOCAL_HEADER', 'DATA_DESCRIPTOR',
-           'process_zip')
-
-class _Struct(struct.Struct):
-    __slots__ = ('marker', '_named_ctor')
-
-    def __init__(self, format, marker):
-        super(_Struct, self).__init__(format)
-        self.marker = marker
-
-    def unpack(self, data):
-        raw = super(_Struct, self).unpack(data)
+from xzip import profiling
+from xzip.explode import (CENTRAL_DIR, CHUNK_SIZE, DATA_DESCRIPTOR, DIGESTS,
+                          DIGEST_NAME, END_OF_DIR, JUMP_ITEM, LOCAL_HEADER,
+                          STREAM_HEADER, descriptor_struct, find_end_of_dir,
+                          get_digest, read_chunks, zip64_info)
 
-        try:
-            return self._named_ctor(raw)
-        except AttributeError:
-            return raw
+__all__ = ('CENTRAL_DIR', 'END_OF_DIR', 'LOCAL_HEADER', 'DATA_DESCRIPTOR',
+           'Archive', 'Member', 'CorpusStats', 'find_archives', 'parser',
+           'process_file', 'process_zip')
 
-CENTRAL_DIR = _Struct('<4s6H3L5H2L', b'PK\x01\x02')
-CENTRAL_DIR._named_ctor = namedtuple('CentralDirectory',
-        ('signature', 'creator_version', 'needed_version', 'flag',
-         'compression', 'mod_time', 'mod_date', 'crc', 'compressed_size',
-         'raw_size', 'filename_len', 'extra_field_len', 'comment_len',
-         'disk_num_start', 'internal_attr', 'external_attr', 'offset'))._make
+Archive = namedtuple('Archive', 'filename size meta_size members')
 
-END_OF_DIR = _Struct('<4s4H2LH', b'PK\x05\x06')
-END_OF_DIR._named_ctor = namedtuple('EndOfArchive',
-        ('signature', 'disk_num', 'first_disk', 'local_entries',
-         'total_entries', 'directory_size', 'directory_offset',
-         'comment_len'))._make
+# digests are binary, decompressed_digest is None if the compression method
+# is not supported
+Member = namedtuple('Member', 'filename digest decompressed_digest '
+                              'compressed_size raw_size')
 
-LOCAL_HEADER = _Struct('<4s5H3L2H', b'PK\x03\x04')
-LOCAL_HEADER._named_ctor = namedtuple('LocalHeader',
-        ('signature', 'needed_version', 'flag', 'compression',
-         'mod_time', 'mod_date', 'crc', 'compressed_size', 'raw_size',
-         'filename_len', 'extra_field_len'))._make
 
-DATA_DESCRIPTOR = _Struct('<3L', b'PK\x07\x08')
-DATA_DESCRIPTOR._named_ctor = namedtuple('DataDescriptor',
-        ('crc', 'compressed_size', 'raw_size'))._make
+def process_zip(filename, digest='sha1'):
+    '''
+    Hashes the members of the zip ``filename`` and returns an ``Archive`` or
+    ``None`` if it is not a zip file. ``meta_size`` is the size ``zipexplode``
+    would store in the meta directory.
+    '''
 
-WRITER = csv.writer(sys.stdout)
+    digest = get_digest(digest)
 
-def process_zip(filename):
     with open(filename, 'rb') as file:
-        try:
-            file.seek(-END_OF_DIR.size, 2)
-        except IOError:
-            # file too small, probably not a zip
-            return
-
-        eoa = END_OF_DIR.unpack(file.read())
-        if eoa.signature != END_OF_DIR.marker:
-            file.seek(max(file.tell() - (2 ** 16 + END_OF_DIR.size), 0))
-            tmp = file.read()
-            index = tmp.rfind(END_OF_DIR.marker)
-            if index < 0: return
+        eoa = find_end_of_dir(file)
+        if eoa is None: return
 
-            eoa = END_OF_DIR.unpack(tmp[index:index + END_OF_DIR.size])
+        file.seek(0, 2)
+        size = file.tell()
 
-
-        WRITER.writerow(('Filename', 'Stream Hash', 'Raw Hash',
-                         'Decompressed Hash'))
+        # the stream header, the first jump item and the copied central
+        # directory
+        meta_size = (STREAM_HEADER.size + DIGEST_NAME.size +
+                     len(digest.name) + JUMP_ITEM.size + size -
+                     eoa.directory_offset)
+        members = []
 
         file.seek(eoa.directory_offset)
         for _ in range(eoa.total_entries):
             info = CENTRAL_DIR.unpack(file.read(CENTRAL_DIR.size))
-            WRITER.writerow(process_file(file, info))
-            file.read(info.filename_len + info.extra_field_len +
-                      info.comment_len)
+            var_fields = file.read(info.filename_len + info.extra_field_len +
+                                   info.comment_len)
+            info = zip64_info(info, var_fields[
+                    info.filename_len:
+                    info.filename_len + info.extra_field_len])
+
+            member, member_meta = process_file(file, info, digest.name)
+            members.append(member)
+            meta_size += member_meta
 
+    return Archive(filename, size, meta_size, members)
+
+
+def process_file(file, info, digest='sha1'):
+    '''
+    Hashes the compressed and decompressed data of the member described by
+    the central directory item ``info`` and returns the ``Member`` and the
+    size of its stream and jump items
+    '''
 
-def process_file(file, info):
     pos = file.tell()
-    hash = sha1()
+    digest = get_digest(digest)
 
     # go to the local header and unpack it
     file.seek(info.offset)
-    header = file.read(LOCAL_HEADER.size)
-    hash.update(header)
-    header = LOCAL_HEADER.unpack(header)
+    header = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
 
     # save the filename (assume utf-8 even though cp437 was what PKWARE
     # used initially)
-    filename = file.read(header.filename_len).decode('utf-8')
-    hash.update(filename)
-
-    # read the extra field and the compressed data (header doesn't always have
-    # the size, so it's safer to use the central directory information)
-    hash.update(file.read(header.extra_field_len))
-    data = file.read(info.compressed_size)
-    hash.update(data)
+    var_fields = file.read(header.filename_len + header.extra_field_len)
+    filename = var_fields[:header.filename_len].decode('utf-8', 'replace')
 
+    # read the compressed data in chunks (header doesn't always have the
+    # size, so it's safer to use the central directory information)
+    hash = digest.new()
     if header.compression == 8:
-        decompressed = zlib.decompress(data, -15)
+        decompressor = zlib.decompressobj(-15)
+        decompressed = digest.new()
     else:
-        decompressed = data
+        decompressor = None
+        decompressed = hash if header.compression == 0 else None
+
+    for chunk in read_chunks(file, info.compressed_size):
+        hash.update(chunk)
 
-    # check if there is a data descriptor here
+        # bound the decompressed size held in memory
+        while decompressor and chunk:
+            decompressed.update(decompressor.decompress(chunk, CHUNK_SIZE))
+            chunk = decompressor.unconsumed_tail
+
+    if decompressor: decompressed.update(decompressor.flush())
+
+    # check if there is a data descriptor here (zip64 members have 64-bit
+    # sizes in the descriptor)
+    descriptor_len = 0
+    descriptor_format = descriptor_struct(var_fields[header.filename_len:])
     if file.read(len(DATA_DESCRIPTOR.marker)) == DATA_DESCRIPTOR.marker:
-        hash.update(DATA_DESCRIPTOR.marker)
-        hash.update(file.read(DATA_DESCRIPTOR.size))
+        descriptor_len = len(DATA_DESCRIPTOR.marker) + descriptor_format.size
 
-    elif header.flag & 3:
-        file.seek(-len(DATA_DESCRIPTOR.marker), 1)
-        hash.update(file.read(DATA_DESCRIPTOR.size))
+    elif header.flag & 0b1000:
+        descriptor_len = descriptor_format.size
 
     file.seek(pos)
-    return (filename, hash.hexdigest(), sha1(data).hexdigest(),
-            sha1(decompressed).hexdigest())
+
+    member = Member(filename, hash.digest(),
+                    decompressed.digest() if decompressed is not None
+                    else None,
+                    info.compressed_size, info.raw_size)
+    return member, (digest.stream_item.size + len(var_fields) +
+                    descriptor_len + JUMP_ITEM.size)
+
+
+class CorpusStats(object):
+    'Aggregates the deduplication potential of many ``Archive``'
+
+    def __init__(self):
+        self.archives = 0
+        self.members = 0
+        self.archive_bytes = 0
+        self.member_bytes = 0
+        self.raw_bytes = 0
+        self.meta_bytes = 0
+
+        # digest -> [count, compressed size, decompressed digest, filename]
+        self.blobs = {}
+
+    def add(self, archive):
+        self.archives += 1
+        self.archive_bytes += archive.size
+        self.meta_bytes += archive.meta_size
+
+        blobs = self.blobs
+        for member in archive.members:
+            self.members += 1
+            self.member_bytes += member.compressed_size
+            self.raw_bytes += member.raw_size
+
+            blob = blobs.get(member.digest)
+            if blob:
+                blob[0] += 1
+            else:
+                blobs[member.digest] = [1, member.compressed_size,
+                                        member.decompressed_digest,
+                                        member.filename]
+
+    def summary(self, top=20):
+        '''
+        Returns the aggregated statistics. Blobs with the same decompressed
+        content but different compressed bytes (other compression levels or
+        tools) are only deduplicated by a decompressing store, the bytes
+        given for them are what keeping one copy of each content would save.
+        '''
+
+        unique_bytes = 0
+        contents = {}
+        for count, size, decompressed, _ in self.blobs.values():
+            unique_bytes += size
+            if decompressed is not None:
+                contents.setdefault(decompressed, []).append(size)
+
+        variants = [sizes for sizes in contents.values() if len(sizes) > 1]
+        stored = unique_bytes + self.meta_bytes
+
+        duplicated = sorted(((blob[0] - 1) * blob[1], digest, blob)
+                            for digest, blob in self.blobs.items()
+                            if blob[0] > 1)
+        duplicated.reverse()
+
+        return {
+            'archives': self.archives,
+            'members': self.members,
+            'archive_bytes': self.archive_bytes,
+            'member_bytes': self.member_bytes,
+            'raw_bytes': self.raw_bytes,
+            'unique_blobs': len(self.blobs),
+            'unique_blob_bytes': unique_bytes,
+            'duplicate_members': self.members - len(self.blobs),
+            'decompressed_only_contents': len(variants),
+            'decompressed_only_blobs': sum(len(sizes) - 1
+                                           for sizes in variants),
+            'decompressed_only_bytes': sum(sum(sizes) - min(sizes)
+                                           for sizes in variants),
+            'projected_meta_bytes': self.meta_bytes,
+            'projected_store_bytes': stored,
+            'projected_saved_bytes': self.archive_bytes - stored,
+            'dedup_ratio': float(self.archive_bytes) / max(stored, 1),
+            'top_duplicated': [{
+                'filename': blob[3],
+                'digest': b2a_hex(digest).decode('ascii'),
+                'count': blob[0],
+                'compressed_size': blob[1],
+                'saved_bytes': saved,
+            } for saved, digest, blob in duplicated[:top]],
+        }
+
+
+def find_archives(paths, pattern='*.zip'):
+    '''
+    Yields the files in ``paths`` and the files matching ``pattern`` below
+    the directories in ``paths``
+    '''
+
+    for name in paths:
+        if not path.isdir(name):
+            yield name
+            continue
+
+        for root, dirs, files in os.walk(name):
+            dirs.sort()
+            for filename in sorted(files):
+                if fnmatch(filename, pattern):
+                    yield path.join(root, filename)
+
+
+parser = ArgumentParser(description='Estimates the deduplication potential '
+                                    'of a corpus of zip files.')
+
+parser.add_argument('-j', '--jobs', type=int, default=None,
+                    help='number of worker processes (default: CPU count)')
+
+parser.add_argument('--digest', choices=sorted(DIGESTS), default='sha1',
+                    help='digest used to compare the members')
+
+parser.add_argument('--pattern', default='*.zip',
+                    help='zip files to analyze in directories '
+                         '(default: %(default)s)')
+
+parser.add_argument('-f', '--format', choices=('json', 'csv', 'members'),
+                    default='json', help='output the corpus statistics as '
+                                         'JSON or CSV, or a CSV line per '
+                                         'member')
+
+parser.add_argument('--top', type=int, default=20,
+                    help='number of most duplicated members to list')
+
+parser.add_argument('-o', '--output', metavar='FILE', default=None,
+                    help='write to FILE instead of stdout')
+
+profiling.add_arguments(parser)
+
+parser.add_argument('paths', metavar='PATH', nargs='+',
+                    help='zip files or directories to search for zip files')
+
+
+def _text(value):
+    # the csv module of Python 2 only writes byte strings
+    if bytes is str and not isinstance(value, bytes):
+        return value.encode('utf-8')
+
+    return value
+
+
+def _analyze(args):
+    filename, digest = args
+
+    try:
+        return filename, process_zip(filename, digest), None
+    except (IOError, OSError, ValueError, struct.error, zlib.error) as e:
+        return filename, None, str(e)
+
+
+def _write_csv(output, summary):
+    writer = csv.writer(output)
+    writer.writerow(('Statistic', 'Value'))
+    for key, value in sorted(summary.items()):
+        if key != 'top_duplicated': writer.writerow((key, value))
+
+    writer.writerow(())
+    writer.writerow(('Filename', 'Digest', 'Count', 'Compressed Size',
+                     'Saved Bytes'))
+    for item in summary['top_duplicated']:
+        writer.writerow((_text(item['filename']), item['digest'],
+                         item['count'], item['compressed_size'],
+                         item['saved_bytes']))
+
+
+def _run(args, output):
+    items = [(filename, args.digest)
+             for filename in find_archives(args.paths, args.pattern)]
+
+    if args.jobs == 1:
+        pool = None
+        results = (_analyze(item) for item in items)
+    else:
+        pool = Pool(args.jobs)
+        results = pool.imap_unordered(_analyze, items, 4)
+
+    stats = CorpusStats()
+    if args.format == 'members':
+        writer = csv.writer(output)
+        writer.writerow(('Archive', 'Filename', 'Digest',
+                         'Decompressed Digest', 'Compressed Size',
+                         'Raw Size'))
+
+    failed = 0
+    try:
+        for filename, archive, error in results:
+            if error:
+                sys.stderr.write('%s: %s\n' % (filename, error))
+                failed += 1
+                continue
+            elif archive is None:
+                continue
+
+            stats.add(archive)
+            if args.format != 'members': continue
+
+            for member in archive.members:
+                writer.writerow((
+                        _text(filename), _text(member.filename),
+                        b2a_hex(member.digest).decode('ascii'),
+                        member.decompressed_digest and
+                        b2a_hex(member.decompressed_digest).decode('ascii'),
+                        member.compressed_size, member.raw_size))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    if args.format == 'json':
+        json.dump(stats.summary(args.top), output, indent=2, sort_keys=True)
+        output.write('\n')
+    elif args.format == 'csv':
+        _write_csv(output, stats.summary(args.top))
+
+    return failed
 
 
 def main():
-    process_zip(sys.argv[1])
+    args = parser.parse_args()
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    profiler = profiling.from_args(args)
+    if profiler:
+        profiler.install_signal()
+        profiler.start()
+
+    try:
+        failed = _run(args, output)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.dump()
+
+        if output is not sys.stdout: output.close()
+
+    sys.exit(1 if failed else 0)
 
 if __name__ == '__main__':
     main()
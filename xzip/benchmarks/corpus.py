@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import random
+import zlib
+
+from os import path
+
+from xzip.explode import (CENTRAL_DIR, DATA_DESCRIPTOR, END_OF_DIR,
+                          LOCAL_HEADER)
+
+__all__ = ('DISTRIBUTIONS', 'generate', 'write_zip')
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+# 2012-07-28 00:00 in DOS format, a fixed time keeps the corpus reproducible
+_DOS_TIME, _DOS_DATE = 0, (32 << 9) | (7 << 5) | 28
+_TEXT_SIZE = 2 ** 20
+
+
+def _text(rng):
+    'Returns a block of compressible pseudo text'
+
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in range(rng.randint(2, 10)))
+             for _ in range(2000)]
+
+    text = []
+    length = 0
+    while length < _TEXT_SIZE:
+        line = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 16)))
+        text.append(line)
+        length += len(line) + 1
+
+    return '\n'.join(text).encode('ascii')[:_TEXT_SIZE]
+
+
+def _content(rng, text, size, salt):
+    'Returns ``size`` bytes unique to ``salt``'
+
+    data = ('%s\n' % salt).encode('ascii')
+    while len(data) < size:
+        offset = rng.randrange(len(text))
+        data += text[offset:offset + size - len(data)]
+
+    return data[:size]
+
+
+def _size(rng, size, distribution):
+    if distribution == 'fixed':
+        return size
+    elif distribution == 'uniform':
+        return rng.randint(0, 2 * size)
+    elif distribution == 'lognormal':
+        # median of size / 2 with a long tail (mean of roughly size)
+        return min(int(rng.lognormvariate(0, 1.2) * size / 2), 64 * size)
+    else:
+        raise ValueError('unknown distribution: %s' % distribution)
+
+
+def write_zip(filename, entries):
+    '''
+    Writes a zip file from a sequence of (name, data, compression,
+    descriptor) entries. ``compression`` is 0 (stored) or 8 (deflated) and
+    ``descriptor`` selects a trailing data descriptor instead of sizes in the
+    local header.
+    '''
+
+    directory = []
+    with open(filename, 'wb') as file:
+        for name, data, compression, descriptor in entries:
+            name = name.encode('utf-8')
+            crc = zlib.crc32(data) & 0xffffffff
+
+            if compression == 8:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                compressed = compressor.compress(data) + compressor.flush()
+            else:
+                compressed = data
+
+            flag = 0b1000 if descriptor else 0
+            offset = file.tell()
+            sizes = (crc, len(compressed), len(data))
+
+            file.write(LOCAL_HEADER.pack(*((LOCAL_HEADER.marker, 20, flag,
+                                            compression, _DOS_TIME, _DOS_DATE)
+                                           + ((0, 0, 0) if descriptor
+                                              else sizes)
+                                           + (len(name), 0))))
+            file.write(name)
+            file.write(compressed)
+
+            if descriptor:
+                file.write(DATA_DESCRIPTOR.marker)
+                file.write(DATA_DESCRIPTOR.pack(*sizes))
+
+            directory.append(CENTRAL_DIR.pack(*((CENTRAL_DIR.marker, 20, 20,
+                                                 flag, compression, _DOS_TIME,
+                                                 _DOS_DATE) + sizes +
+                                                (len(name), 0, 0, 0, 0, 0,
+                                                 offset))) + name)
+
+        directory_offset = file.tell()
+        for item in directory:
+            file.write(item)
+
+        file.write(END_OF_DIR.pack(END_OF_DIR.marker, 0, 0, len(directory),
+                                   len(directory),
+                                   file.tell() - directory_offset,
+                                   directory_offset, 0))
+
+
+def generate(directory, archives=10, members=100, size=16384,
+             distribution='lognormal', duplication=0.5, descriptors=0.0,
+             stored=0.1, seed=0):
+    '''
+    Generates a corpus of zip files in ``directory`` and returns their paths.
+    The corpus is reproducible for a given ``seed`` and Python version.
+
+    ``size`` and ``distribution`` control the member sizes, ``duplication`` is
+    the probability of a member being taken from a pool shared by all the
+    archives, ``descriptors`` the probability of a member using a data
+    descriptor and ``stored`` the probability of a member not being
+    compressed.
+    '''
+
+    if members > 0xffff:
+        raise ValueError('the corpus generator does not write zip64 archives')
+
+    rng = random.Random(seed)
+    text = _text(rng)
+
+    # shared members always have the same name and compression so they
+    # deduplicate like the members of related build artifacts
+    shared = [('shared/%05d' % i,
+               _content(rng, text, _size(rng, size, distribution),
+                        'shared %d' % i),
+               0 if rng.random() < stored else 8)
+              for i in range(members)]
+
+    if not path.isdir(directory): os.makedirs(directory)
+
+    filenames = []
+    for archive in range(archives):
+        entries = []
+        for member in range(members):
+            if rng.random() < duplication:
+                name, data, compression = shared[rng.randrange(members)]
+            else:
+                name = 'unique/%05d' % member
+                data = _content(rng, text, _size(rng, size, distribution),
+                                'archive %d member %d' % (archive, member))
+                compression = 0 if rng.random() < stored else 8
+
+            entries.append((name, data, compression,
+                            rng.random() < descriptors))
+
+        filename = path.join(directory, 'corpus-%05d.zip' % archive)
+        write_zip(filename, entries)
+        filenames.append(filename)
+
+    return filenames
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import shutil
+import tempfile
+
+from os import path
+
+from xzip.benchmarks.results import timer
+from xzip.explode import process_zip
+
+__all__ = ('store_size', 'bench_explode')
+
+
+def store_size(base):
+    'Returns the (data, meta) bytes used by an exploded store'
+
+    sizes = []
+    for directory in ('data', 'meta'):
+        total = 0
+        for root, _, files in os.walk(path.join(base, directory)):
+            total += sum(os.path.getsize(path.join(root, f)) for f in files)
+
+        sizes.append(total)
+
+    return tuple(sizes)
+
+
+def bench_explode(filenames, depth=0, digest='sha1', repeat=3, base=None):
+    '''
+    Explodes ``filenames`` into an empty store ``repeat`` times and returns
+    the metrics of the fastest run. The last store is kept in ``base`` if
+    it is given, which must not exist or be empty (otherwise a temporary
+    directory is used and removed).
+    '''
+
+    if base and path.exists(base) and \
+            (not path.isdir(base) or os.listdir(base)):
+        raise ValueError('%s already exists and is not empty' % base)
+
+    input_bytes = sum(os.path.getsize(f) for f in filenames)
+    times = []
+
+    for run in range(repeat):
+        store = tempfile.mkdtemp(prefix='xzip-bench-')
+
+        try:
+            start = timer()
+            for filename in filenames:
+                process_zip(filename, depth=depth, base=store, digest=digest)
+            times.append(timer() - start)
+
+            data_bytes, meta_bytes = store_size(store)
+        finally:
+            if base and run == repeat - 1:
+                if not path.isdir(base): os.makedirs(base)
+                for name in os.listdir(store):
+                    shutil.move(path.join(store, name), base)
+                os.rmdir(store)
+            else:
+                shutil.rmtree(store)
+
+    best = min(times)
+    return {
+        'archives': len(filenames),
+        'input_bytes': input_bytes,
+        'data_bytes': data_bytes,
+        'meta_bytes': meta_bytes,
+        'dedup_ratio': float(input_bytes) / max(data_bytes + meta_bytes, 1),
+        'seconds': best,
+        'archives_per_second': len(filenames) / best,
+        'bytes_per_second': input_bytes / best,
+    }
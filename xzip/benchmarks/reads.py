@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import random
+import threading
+
+from xzip.benchmarks.results import percentiles, timer
+from xzip.fs import ExplodedZip
+
+__all__ = ('PATTERNS', 'TAIL_SIZE', 'bench_read')
+
+PATTERNS = ('sequential', 'random', 'tail-first', 'concurrent')
+
+# zip readers start by reading the end of central directory and the central
+# directory at the end of the file
+TAIL_SIZE = 2 ** 16
+
+
+def _offsets(pattern, size, block_size, reads, rng):
+    if pattern == 'sequential':
+        return range(0, size, block_size)
+    elif pattern == 'tail-first':
+        tail = max(size - TAIL_SIZE, 0)
+        return ([tail] + list(range(tail + block_size, size, block_size)) +
+                list(range(0, tail, block_size)))
+    else:
+        return [rng.randrange(max(size, 1)) for _ in range(reads)]
+
+
+def _read(operations, name, offsets, block_size, latencies):
+    'Reads ``offsets`` of ``name`` recording each read in ``latencies``'
+
+    path = '/' + name
+    start = timer()
+    fh = operations.open(path, os.O_RDONLY)
+    latencies['open'].append(timer() - start)
+
+    total = 0
+    try:
+        for offset in offsets:
+            start = timer()
+            total += len(operations.read(path, block_size, offset, fh))
+            latencies['read'].append(timer() - start)
+    finally:
+        operations.release(path, fh)
+
+    return total
+
+
+def bench_read(base, names, pattern='sequential', depth=0,
+               block_size=2 ** 17, reads=1000, threads=4, seed=0):
+    '''
+    Reads the exploded archives ``names`` through ``ExplodedZip`` (without a
+    kernel mount) with one of the ``PATTERNS`` and returns the metrics.
+    ``block_size`` defaults to the FUSE maximum read size and ``reads`` is
+    the number of reads per archive of the random patterns.
+    '''
+
+    if pattern not in PATTERNS:
+        raise ValueError('unknown pattern: %s' % pattern)
+
+    operations = ExplodedZip(base=base, depth=depth)
+    rng = random.Random(seed)
+    sizes = dict((name, operations.getattr('/' + name)['st_size'])
+                 for name in names)
+
+    latencies = {'open': [], 'read': []}
+    total = [0]
+
+    start = timer()
+    if pattern == 'concurrent':
+        # every thread has its own handles, like concurrent FUSE requests,
+        # and the reads of an archive are shared out between them
+        jobs = [[] for _ in range(threads)]
+        for index, name in enumerate(names * threads):
+            thread = index % threads
+            count = reads // threads + (thread < reads % threads)
+            jobs[thread].append((name, _offsets('random', sizes[name],
+                                                block_size, count, rng)))
+
+        lock = threading.Lock()
+        def worker(items):
+            local = {'open': [], 'read': []}
+            count = sum(_read(operations, name, offsets, block_size, local)
+                        for name, offsets in items)
+
+            with lock:
+                total[0] += count
+                for key in latencies: latencies[key].extend(local[key])
+
+        workers = [threading.Thread(target=worker, args=(items,))
+                   for items in jobs]
+        for thread in workers: thread.start()
+        for thread in workers: thread.join()
+
+    else:
+        for name in names:
+            total[0] += _read(operations, name,
+                              _offsets(pattern, sizes[name], block_size,
+                                       reads, rng),
+                              block_size, latencies)
+
+    seconds = max(timer() - start, 1e-9)
+
+    metrics = {
+        'archives': len(names),
+        'reads': len(latencies['read']),
+        'bytes': total[0],
+        'seconds': seconds,
+        'bytes_per_second': total[0] / seconds,
+        'reads_per_second': len(latencies['read']) / seconds,
+    }
+
+    for kind, samples in latencies.items():
+        for point, value in percentiles(samples).items():
+            metrics['%s_%s' % (kind, point)] = value
+
+    return metrics
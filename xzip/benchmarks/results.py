@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import json
+import platform
+import time
+
+__all__ = ('FORMAT_VERSION', 'timer', 'percentiles', 'record', 'save',
+           'load', 'compare')
+
+FORMAT_VERSION = 1
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    'Returns the given percentiles of ``samples`` in milliseconds'
+
+    samples = sorted(samples)
+    if not samples: return {}
+
+    return dict(('p%d_ms' % point,
+                 samples[min(len(samples) - 1,
+                             int(len(samples) * point / 100.0))] * 1000)
+                for point in points)
+
+
+def record(benchmarks, parameters):
+    'Wraps benchmark metrics with the information needed to compare runs'
+
+    return {
+        'format': FORMAT_VERSION,
+        'created': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'benchmarks': benchmarks,
+    }
+
+
+def save(results, filename):
+    with open(filename, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as input:
+        results = json.load(input)
+
+    if results.get('format') != FORMAT_VERSION:
+        raise ValueError('%s: unsupported results format' % filename)
+
+    return results
+
+
+def _better(metric):
+    'Returns 1 if higher values are better, -1 if lower, 0 if neither'
+
+    if metric.endswith('_per_second') or metric == 'dedup_ratio':
+        return 1
+    elif metric.endswith('_ms') or metric == 'seconds':
+        return -1
+    else:
+        return 0
+
+
+def compare(old, new, threshold=0.05):
+    '''
+    Yields (benchmark, metric, old, new, change, verdict) for every metric in
+    both results. ``change`` is relative and ``verdict`` is ``'regression'``,
+    ``'improvement'`` or ``''`` depending on ``threshold``.
+    '''
+
+    for benchmark in sorted(set(old['benchmarks']) & set(new['benchmarks'])):
+        before = old['benchmarks'][benchmark]
+        after = new['benchmarks'][benchmark]
+
+        for metric in sorted(set(before) & set(after)):
+            a, b = before[metric], after[metric]
+            if not isinstance(a, (int, float)) or not a: continue
+
+            change = (b - a) / float(a)
+            verdict = ''
+            if abs(change) >= threshold and _better(metric):
+                verdict = ('improvement' if change * _better(metric) > 0
+                           else 'regression')
+
+            yield benchmark, metric, a, b, change, verdict
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import os
+import shutil
+import sys
+import tempfile
+
+from argparse import ArgumentParser
+from os import path
+
+from xzip.benchmarks import corpus, results
+
+__all__ = ('parser',)
+
+
+parser = ArgumentParser(description='Benchmarks exploding and reading '
+                                    'exploded zip files.')
+commands = parser.add_subparsers(dest='command')
+
+def _corpus_options(command):
+    command.add_argument('--archives', type=int, default=10,
+                         help='number of zip files')
+    command.add_argument('--members', type=int, default=100,
+                         help='members per zip file')
+    command.add_argument('--size', type=int, default=16384,
+                         help='typical member size in bytes')
+    command.add_argument('--distribution', choices=corpus.DISTRIBUTIONS,
+                         default='lognormal', help='member size distribution')
+    command.add_argument('--duplication', type=float, default=0.5,
+                         help='probability of a member being shared')
+    command.add_argument('--descriptors', type=float, default=0.0,
+                         help='probability of a member using a data '
+                              'descriptor')
+    command.add_argument('--stored', type=float, default=0.1,
+                         help='probability of a member not being compressed')
+    command.add_argument('--seed', type=int, default=0,
+                         help='random seed of the corpus')
+
+generate = commands.add_parser('corpus', help='generate a zip corpus')
+_corpus_options(generate)
+generate.add_argument('directory', help='directory for the zip files')
+
+run = commands.add_parser('run', help='run the benchmarks')
+_corpus_options(run)
+run.add_argument('-c', '--corpus', metavar='DIR', default=None,
+                 help='use the zip files in DIR instead of generating them')
+run.add_argument('--depth', type=int, default=0,
+                 help='data subdirectory depth')
+run.add_argument('--digest', default='sha1',
+                 help='digest used to name the data files')
+run.add_argument('--repeat', type=int, default=3,
+                 help='explode repetitions (the fastest is reported)')
+run.add_argument('--patterns', nargs='+', default=None,
+                 metavar='PATTERN', help='read patterns (default: all)')
+run.add_argument('--block-size', type=int, default=2 ** 17,
+                 help='bytes per read')
+run.add_argument('--reads', type=int, default=1000,
+                 help='random reads per zip file')
+run.add_argument('--threads', type=int, default=4,
+                 help='threads of the concurrent read pattern')
+run.add_argument('-o', '--output', metavar='FILE', default=None,
+                 help='write the results to FILE as JSON')
+
+compare = commands.add_parser('compare', help='compare two result files')
+compare.add_argument('--threshold', type=float, default=0.05,
+                     help='relative change reported as a regression or '
+                          'improvement')
+compare.add_argument('old', help='baseline results')
+compare.add_argument('new', help='new results')
+
+
+def _corpus_parameters(args):
+    return dict((key, getattr(args, key)) for key in
+                ('archives', 'members', 'size', 'distribution',
+                 'duplication', 'descriptors', 'stored', 'seed'))
+
+
+def _run(args):
+    # the mount is only needed (and importable) for the read benchmarks
+    from xzip.benchmarks.ingest import bench_explode
+    from xzip.benchmarks.reads import PATTERNS, bench_read
+
+    work = tempfile.mkdtemp(prefix='xzip-bench-')
+    try:
+        if args.corpus:
+            filenames = sorted(path.join(args.corpus, f)
+                               for f in os.listdir(args.corpus)
+                               if f.endswith('.zip'))
+        else:
+            filenames = corpus.generate(path.join(work, 'corpus'),
+                                        **_corpus_parameters(args))
+
+        store = path.join(work, 'store')
+        benchmarks = {
+            'explode': bench_explode(filenames, depth=args.depth,
+                                     digest=args.digest, repeat=args.repeat,
+                                     base=store)
+        }
+
+        names = [path.basename(f) for f in filenames]
+        for pattern in args.patterns or PATTERNS:
+            benchmarks['read-' + pattern] = bench_read(
+                    store, names, pattern, depth=args.depth,
+                    block_size=args.block_size, reads=args.reads,
+                    threads=args.threads, seed=args.seed)
+    finally:
+        shutil.rmtree(work)
+
+    parameters = dict((key, getattr(args, key)) for key in
+                      ('corpus', 'depth', 'digest', 'repeat', 'block_size',
+                       'reads', 'threads'))
+    parameters.update(_corpus_parameters(args))
+
+    output = results.record(benchmarks, parameters)
+    if args.output:
+        results.save(output, args.output)
+
+    for benchmark, metrics in sorted(benchmarks.items()):
+        print('%s: %s' % (benchmark, ', '.join(
+                '%s=%.6g' % item for item in sorted(metrics.items()))))
+
+
+def _compare(args):
+    old, new = results.load(args.old), results.load(args.new)
+    for key in ('parameters', 'python'):
+        if old[key] != new[key]:
+            sys.stderr.write('warning: the runs have different %s\n' % key)
+
+    regressions = 0
+    for row in results.compare(old, new, args.threshold):
+        benchmark, metric, old, new, change, verdict = row
+        print('%-16s %-24s %14.6g %14.6g %+8.1f%% %s' %
+              (benchmark, metric, old, new, change * 100, verdict))
+
+        if verdict == 'regression': regressions += 1
+
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    args = parser.parse_args()
+
+    if args.command == 'corpus':
+        corpus.generate(args.directory, **_corpus_parameters(args))
+    elif args.command == 'run':
+        _run(args)
+    elif args.command == 'compare':
+        _compare(args)
+    else:
+        parser.print_usage()
+
+if __name__ == '__main__':
+    main()
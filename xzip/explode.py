@@ -1,18 +1,45 @@
 #!/usr/bin/env python
 # vim: set fileencoding=utf-8 :
 
+import errno
+import json
 import os
+import re
+import shutil
+import signal
 import struct
 import sys
+import tempfile
+import time
 import zlib
 
 from argparse import ArgumentParser
+from binascii import hexlify
 from collections import namedtuple
 from hashlib import sha1
+from io import BytesIO
 from os import path
 
+from xzip import profiling, watch
+from xzip.metrics import timer
+from xzip.store import DirectoryStore, _makedirs
+
 __all__ = ('CENTRAL_DIR', 'END_OF_DIR', 'LOCAL_HEADER', 'DATA_DESCRIPTOR',
-           'STREAM_ITEM', 'JUMP_ITEM', 'parser', 'process_zip', 'process_file')
+           'ZIP64_END_OF_DIR', 'ZIP64_LOCATOR', 'ZIP64_DATA_DESCRIPTOR',
+           'ZIP64_EXTRA_ID', 'STREAM_HEADER', 'STREAM_VERSION', 'STREAM_ITEM',
+           'JUMP_ITEM', 'DESCRIPTOR_LEN_MASK', 'ITEM_RECOMPRESSED',
+           'DEFLATE_FINGERPRINT',
+           'ITEM_CHUNKED', 'CHUNK_COUNT', 'ITEM_INLINE', 'INLINE_LENGTH',
+           'COMPACT_HEADER', 'COMPACT_BLOCK', 'CANONICAL_DEFLATE',
+           'DEFLATE_CANDIDATES', 'DIGESTS', 'Digest',
+           'StreamFormat', 'Recompression', 'parser', 'register_digest',
+           'get_digest', 'blob_path', 'write_stream_header',
+           'read_stream_header', 'encode_meta', 'decode_meta', 'read_meta',
+           'open_meta', 'compact_meta', 'extra_fields', 'zip64_info',
+           'find_end_of_dir', 'descriptor_struct', 'deflate_fingerprint',
+           'recompression_size', 'unpack_recompression', 'recompress',
+           'read_chunks', 'chunk_data', 'new_report', 'merge_reports',
+           'process_zip', 'process_file')
 
 class _Struct(struct.Struct):
     __slots__ = ('marker', '_named_ctor')
@@ -52,62 +79,1070 @@ DATA_DESCRIPTOR = _Struct('<3L', b'PK\x07\x08')
 DATA_DESCRIPTOR._named_ctor = namedtuple('DataDescriptor',
         ('crc', 'compressed_size', 'raw_size'))._make
 
+ZIP64_END_OF_DIR = _Struct('<4sQ2H2L4Q', b'PK\x06\x06')
+ZIP64_END_OF_DIR._named_ctor = namedtuple('Zip64EndOfArchive',
+        ('signature', 'record_size', 'creator_version', 'needed_version',
+         'disk_num', 'first_disk', 'local_entries', 'total_entries',
+         'directory_size', 'directory_offset'))._make
+
+ZIP64_LOCATOR = _Struct('<4sLQL', b'PK\x06\x07')
+ZIP64_LOCATOR._named_ctor = namedtuple('Zip64Locator',
+        ('signature', 'disk_num', 'offset', 'total_disks'))._make
+
+ZIP64_DATA_DESCRIPTOR = _Struct('<L2Q', b'PK\x07\x08')
+ZIP64_DATA_DESCRIPTOR._named_ctor = namedtuple('Zip64DataDescriptor',
+        ('crc', 'compressed_size', 'raw_size'))._make
+
+EXTRA_FIELD = struct.Struct('<2H')
+ZIP64_EXTRA_ID = 0x0001
+
+# the stream file starts with a header so the format can evolve (stream
+# files written before the header was introduced are version 1). Since
+# version 3 the header is followed by the length prefixed name of the digest
+# naming the data files, since version 4 stream items may be flagged
+# (see DESCRIPTOR_LEN_MASK), since version 5 they may be chunked, since
+# version 6 they may be inline and since version 7 recompressed items record
+# the fingerprint of the deflate settings (see DEFLATE_FINGERPRINT).
+STREAM_HEADER = _Struct('<4s2H', b'XZIP')
+STREAM_HEADER._named_ctor = namedtuple('StreamHeader',
+        ('signature', 'version', 'flags'))._make
+
+DIGEST_NAME = struct.Struct('<B')
+
+STREAM_VERSION = 7
+
+# compact .dir and .stream files start with a header (the CRC of the decoded
+# data and of the decoded meta file of the base archive, and the length of
+# the base archive name) followed by the name and by blocks of deflated data
+# (see encode_meta)
+COMPACT_HEADER = _Struct('<4s2LH', b'XZMC')
+COMPACT_HEADER._named_ctor = namedtuple('CompactHeader',
+        ('signature', 'crc', 'base_crc', 'base_len'))._make
+
+# offset of the preset dictionary in the base meta file and compressed
+# length of a block
+COMPACT_BLOCK = struct.Struct('<QL')
+_COMPACT_BLOCK_SIZE = 2 ** 14
+_COMPACT_WINDOW = 2 ** 15
+# stream item layout for 20 byte digests (see Digest.stream_item)
 STREAM_ITEM = struct.Struct('<4s5H3L2HB20s')
 JUMP_ITEM = struct.Struct('<2Q')
 
+# data descriptors are at most 24 bytes, the high bits of the descriptor
+# length of a stream item flag members which are not served as is from their
+# data file
+DESCRIPTOR_LEN_MASK = 0x1f
+
+# the data file holds the member deflated with CANONICAL_DEFLATE, the stream
+# item is followed (after the descriptor) by the Recompression which gives
+# back the original bytes (named by the digest of the stream item)
+ITEM_RECOMPRESSED = 0x80
+
+# the Recompression is followed by the crc32 of a probe deflated with its
+# settings by the zlib which reproduced the member (see deflate_fingerprint)
+DEFLATE_FINGERPRINT = struct.Struct('<L')
+
+# the member is stored in content defined chunks, the stream item is followed
+# (after the descriptor) by the number of chunks and the (length, digest) of
+# each one (see Digest.chunk)
+ITEM_CHUNKED = 0x40
+CHUNK_COUNT = struct.Struct('<L')
+
+# the member has no data file, the stream item is followed (after the
+# descriptor) by its length and bytes
+ITEM_INLINE = 0x20
+INLINE_LENGTH = struct.Struct('<L')
+
+# (level, mem_level, strategy) of the data files of recompressed members,
+# zlib's defaults which most zip writers use
+CANONICAL_DEFLATE = (6, 8, zlib.Z_DEFAULT_STRATEGY)
+
+# settings tried in order to reproduce the deflate stream of a member
+DEFLATE_CANDIDATES = [(level, mem_level, strategy)
+                      for strategy in (zlib.Z_DEFAULT_STRATEGY,
+                                       zlib.Z_FILTERED)
+                      for mem_level in (8, 9)
+                      for level in (6, 9, 1, 5, 7, 8, 4, 3, 2)]
+
+CHUNK_SIZE = 2 ** 20
+
+Digest = namedtuple('Digest',
+                    'name size new verify stream_item recompression chunk')
+StreamFormat = namedtuple('StreamFormat', 'version flags digest')
+Recompression = namedtuple('Recompression', 'level mem_level strategy '
+                                            'compressed_size digest '
+                                            'fingerprint')
+
+DIGESTS = {}
+
+def register_digest(name, size, new, verify=False):
+    '''
+    Makes the hash constructor ``new`` available for naming data files.
+    ``verify`` should be set for non-cryptographic hashes so the contents of
+    a data file are compared when its name is already taken.
+    '''
+
+    DIGESTS[name] = Digest(name, size, new, verify,
+                           struct.Struct('<4s5H3L2HB%ds' % size),
+                           struct.Struct('<3BQ%ds' % size),
+                           struct.Struct('<L%ds' % size))
+
+register_digest('sha1', 20, sha1)
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    pass
+else:
+    register_digest('blake2b-160', 20, lambda: blake2b(digest_size=20))
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    # xxhash before 2.0 has neither xxh3_128 nor its alias xxh128
+    _xxh128 = getattr(xxhash, 'xxh3_128', getattr(xxhash, 'xxh128', None))
+    if _xxh128: register_digest('xxh128', 16, _xxh128, verify=True)
+
+
+def get_digest(name):
+    try:
+        return DIGESTS[name]
+    except KeyError:
+        raise ValueError('unsupported digest: %s' % name)
+
+
+def blob_path(digest, depth=0, base='.'):
+    'Returns the path of the data file named by the hex ``digest``'
+
+    return path.join(*([base, 'data'] + list(digest[:depth]) + [digest]))
+
+
+def write_stream_header(stream, digest='sha1', flags=0):
+    name = get_digest(digest).name.encode('ascii')
+
+    stream.write(STREAM_HEADER.pack(STREAM_HEADER.marker, STREAM_VERSION,
+                                    flags))
+    stream.write(DIGEST_NAME.pack(len(name)) + name)
+
+
+def read_stream_header(stream):
+    '''
+    Reads the header of a stream file leaving ``stream`` positioned at the
+    first stream item and returns the ``StreamFormat``. Stream files without
+    a header are reported as version 1, and files before version 3 use sha1.
+    '''
+
+    raw = stream.read(STREAM_HEADER.size)
+    if raw[:len(STREAM_HEADER.marker)] != STREAM_HEADER.marker:
+        stream.seek(0)
+        return StreamFormat(1, 0, DIGESTS['sha1'])
+
+    header = STREAM_HEADER.unpack(raw)
+    if header.version > STREAM_VERSION:
+        raise ValueError('unsupported stream version: %d' % header.version)
+
+    digest = 'sha1'
+    if header.version >= 3:
+        length, = DIGEST_NAME.unpack(stream.read(DIGEST_NAME.size))
+        digest = stream.read(length).decode('ascii')
+
+    return StreamFormat(header.version, header.flags, get_digest(digest))
+
+
+def _meta_compressor(zdict):
+    if not zdict: return zlib.compressobj(9, zlib.DEFLATED, -15, 9)
+
+    try:
+        return zlib.compressobj(9, zlib.DEFLATED, -15, 9,
+                                zlib.Z_DEFAULT_STRATEGY, zdict)
+    except TypeError:
+        raise ValueError('meta data based on another archive requires '
+                         'Python 3.3 or later')
+
+
+def _meta_decompressor(zdict):
+    if not zdict: return zlib.decompressobj(-15)
+
+    try:
+        return zlib.decompressobj(-15, zdict)
+    except TypeError:
+        raise ValueError('meta data based on another archive requires '
+                         'Python 3.3 or later')
+
+
+def encode_meta(data, base=b'', base_name=''):
+    '''
+    Returns the compact form of the meta file ``data``. When the same meta
+    file of the archive ``base_name`` is given as ``base``, ``data`` is
+    deflated in blocks each using the part of ``base`` it most likely
+    repeats as a preset dictionary, which stores the meta data of nearly
+    identical archives as little more than their differences.
+    '''
+
+    name = base_name.encode('utf-8')
+    output = [COMPACT_HEADER.pack(COMPACT_HEADER.marker,
+                                  zlib.crc32(data) & 0xffffffff,
+                                  zlib.crc32(base) & 0xffffffff, len(name)),
+              name]
+
+    size = _COMPACT_BLOCK_SIZE if base else max(len(data), 1)
+    half = _COMPACT_WINDOW // 2
+    drift = 0
+
+    for offset in range(0, len(data), size):
+        block = data[offset:offset + size]
+        start = 0
+
+        if base:
+            # follow the members added or removed since the base archive by
+            # looking for the start of the block around where it is expected
+            expected = offset + drift
+            found = base.find(block[:64], max(expected - 4 * size, 0),
+                              expected + 4 * size + 64)
+            if found >= 0: drift = found - offset
+
+            start = max(min(offset + drift - half,
+                            len(base) - _COMPACT_WINDOW), 0)
+
+        compressor = _meta_compressor(base[start:start + _COMPACT_WINDOW])
+        compressed = compressor.compress(block) + compressor.flush()
+        output.append(COMPACT_BLOCK.pack(start, len(compressed)))
+        output.append(compressed)
+
+    return b''.join(output)
+
+
+def decode_meta(data, load_base):
+    '''
+    Returns the meta file encoded by ``encode_meta`` in ``data``.
+    ``load_base`` is called with the name of the base archive (if any) and
+    the CRC of its meta file when it was used as a base, and returns its
+    decoded meta file.
+    '''
+
+    header = COMPACT_HEADER.unpack(data[:COMPACT_HEADER.size])
+    offset = COMPACT_HEADER.size + header.base_len
+    name = data[COMPACT_HEADER.size:offset].decode('utf-8')
+
+    base = load_base(name, header.base_crc) if name else b''
+    if zlib.crc32(base) & 0xffffffff != header.base_crc:
+        raise ValueError('the meta data of %s changed since it was used as '
+                         'a base' % name)
+
+    output = []
+    while offset < len(data):
+        start, length = COMPACT_BLOCK.unpack(
+                data[offset:offset + COMPACT_BLOCK.size])
+        offset += COMPACT_BLOCK.size
+
+        decompressor = _meta_decompressor(base[start:start + _COMPACT_WINDOW])
+        output.append(decompressor.decompress(data[offset:offset + length]))
+        output.append(decompressor.flush())
+        offset += length
+
+    output = b''.join(output)
+    if zlib.crc32(output) & 0xffffffff != header.crc:
+        raise ValueError('corrupted compact meta data')
+
+    return output
+
+
+_KEPT_CRC = re.compile(r'\.[0-9a-f]{8}$')
+
+
+def _kept_base(filename, crc):
+    # the version of a base meta file kept by _keep_base
+    return '%s.%08x' % (filename, crc)
+
+
+def read_meta(name, suffix, base='.', data=None, _seen=(), _crc=None):
+    '''
+    Returns the contents of the meta file ``suffix`` (``.dir`` or
+    ``.stream``) of the exploded zip ``name``, decoding compact meta files.
+    ``data`` is the contents of the meta file if it was already read.
+    '''
+
+    if name in _seen:
+        raise ValueError('the meta data of %s is based on itself' % name)
+
+    if data is None:
+        filename = path.join(base, 'meta', name + suffix)
+        if _crc is not None: filename = _kept_base(filename, _crc)
+
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+    if not data.startswith(COMPACT_HEADER.marker): return data
+
+    seen = tuple(_seen) + (name,)
+    return decode_meta(data, lambda base_name, crc: _load_base(
+            base_name, suffix, base, crc, seen))
+
+
+def _load_base(name, suffix, base, crc, seen):
+    'Returns the meta file of the base archive ``name`` with the CRC ``crc``'
+
+    try:
+        data = read_meta(name, suffix, base, _seen=seen)
+        if zlib.crc32(data) & 0xffffffff == crc: return data
+    except (IOError, OSError):
+        data = None
+
+    # the base archive was exploded again since it was used as a base
+    try:
+        return read_meta(name, suffix, base, _seen=seen, _crc=crc)
+    except (IOError, OSError):
+        if data is None: raise
+
+        # reported by decode_meta
+        return data
+
+
+def _keep_base(name, suffix, base, seen):
+    '''
+    Returns the decoded meta file ``suffix`` of the base archive ``name``
+    and keeps its current version (named by its CRC), so the archives based
+    on it can still be decoded once ``name`` is exploded again
+    '''
+
+    if name in seen:
+        raise ValueError('the meta data of %s is based on itself' % name)
+
+    # the link is a stable copy of the meta file, even if the base archive
+    # is being exploded again
+    filename = path.join(base, 'meta', name + suffix)
+    tmp = '%s.base.%d.tmp' % (filename, os.getpid())
+    try:
+        os.link(filename, tmp)
+    except OSError as e:
+        if e.errno == errno.ENOENT: raise
+        shutil.copyfile(filename, tmp)
+
+    try:
+        with open(tmp, 'rb') as file:
+            data = file.read()
+
+        if data.startswith(COMPACT_HEADER.marker):
+            data = decode_meta(data, lambda base_name, crc: _load_base(
+                    base_name, suffix, base, crc, tuple(seen) + (name,)))
+
+        os.rename(tmp, _kept_base(filename, zlib.crc32(data) & 0xffffffff))
+    finally:
+        if path.exists(tmp): os.remove(tmp)
+
+    return data
+
+
+def _prune_kept_bases(name, base, before):
+    '''
+    Removes the versions of the meta files of ``name`` kept by _keep_base
+    which no compact meta file is based on any more. Versions kept since
+    ``before`` may be used by an archive which is still being exploded.
+    '''
+
+    meta = path.join(base, 'meta')
+    entries = os.listdir(meta)
+    kept = [(entry, int(entry[-8:], 16)) for entry in entries
+            if entry[:-9] in (name + '.stream', name + '.dir') and
+            _KEPT_CRC.match(entry[-9:])]
+    if not kept: return
+
+    # the bases of every compact meta file, including the kept versions
+    # (which can be based on another archive) and the ones being written
+    used = set()
+    for entry in entries:
+        if entry.endswith('.jump'): continue
 
-def process_zip(filename, depth=0, base='.'):
-    with open(filename, 'rb') as file:
         try:
-            file.seek(-END_OF_DIR.size, 2)
-        except IOError:
-            # file too small, probably not a zip
-            return
+            with open(path.join(meta, entry), 'rb') as file:
+                header = COMPACT_HEADER.unpack(file.read(COMPACT_HEADER.size))
+                if header.signature != COMPACT_HEADER.marker: continue
 
-        eoa = END_OF_DIR.unpack(file.read())
-        filesize = file.tell()
-        if eoa.signature != END_OF_DIR.marker:
-            file.seek(max(file.tell() - (2 ** 16 + END_OF_DIR.size), 0))
-            tmp = file.read()
-            index = tmp.rfind(END_OF_DIR.marker)
-            if index < 0: return
+                used.add((file.read(header.base_len).decode('utf-8'),
+                          header.base_crc))
+        except (IOError, OSError, UnicodeDecodeError, struct.error):
+            # removed in the mean time or not a compact meta file
+            continue
+
+    for entry, crc in kept:
+        if (name, crc) in used: continue
+
+        filename = path.join(meta, entry)
+        try:
+            if os.stat(filename).st_ctime < before: os.remove(filename)
+        except OSError:
+            pass
+
+
+def open_meta(name, suffix, base='.'):
+    '''
+    Opens the meta file ``suffix`` of the exploded zip ``name`` for reading,
+    compact meta files are decoded in memory
+    '''
+
+    file = open(path.join(base, 'meta', name + suffix), 'rb')
+    if file.read(len(COMPACT_HEADER.marker)) != COMPACT_HEADER.marker:
+        file.seek(0)
+        return file
+
+    file.close()
+    return BytesIO(read_meta(name, suffix, base))
+
+
+def compact_meta(name, base='.', meta_base=None):
+    '''
+    Rewrites the ``.dir`` and ``.stream`` files of the exploded zip ``name``
+    in their compact form, as differences from the exploded zip
+    ``meta_base`` if given
+    '''
+
+    # the compact files and the .jump file get a new modification time
+    # together (see _stamp_meta)
+    prefix = path.join(base, 'meta', name)
+    now = time.time()
+    for suffix in ('.stream', '.dir'):
+        _compact_file(prefix + suffix, name, suffix, base, meta_base, now)
+    os.utime(prefix + '.jump', (now, now))
+
+
+def _stamp_meta(filenames):
+    '''
+    Gives the meta files of an archive the same modification time, which
+    tells the mount they belong together while they are being replaced
+    '''
+
+    now = time.time()
+    for filename in filenames: os.utime(filename, (now, now))
+
+
+def _compact_file(filename, name, suffix, base, meta_base, mtime=None):
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    if data.startswith(COMPACT_HEADER.marker):
+        data = decode_meta(data, lambda base_name, crc: _load_base(
+                base_name, suffix, base, crc, (name,)))
+
+    base_data = (_keep_base(meta_base, suffix, base, (name,))
+                 if meta_base else b'')
+
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as file:
+        file.write(encode_meta(data, base_data, meta_base or ''))
+
+    if mtime is not None: os.utime(tmp, (mtime, mtime))
+    os.rename(tmp, filename)
+
+
+def extra_fields(extra):
+    'Yields the (id, data) pairs of a zip extra field block'
+
+    offset = 0
+    while offset + EXTRA_FIELD.size <= len(extra):
+        id, size = EXTRA_FIELD.unpack(
+                extra[offset:offset + EXTRA_FIELD.size])
+        offset += EXTRA_FIELD.size
+
+        yield id, extra[offset:offset + size]
+        offset += size
+
+
+def zip64_info(info, extra):
+    '''
+    Returns ``info`` (a central directory or local header tuple) with the
+    values which overflowed replaced by the ones in the zip64 extra field
+    '''
+
+    fields = [name for name in ('raw_size', 'compressed_size', 'offset')
+              if getattr(info, name, None) == 0xffffffff]
+    if not fields: return info
+
+    for id, data in extra_fields(extra):
+        if id == ZIP64_EXTRA_ID:
+            count = min(len(fields), len(data) // 8)
+            values = struct.unpack('<%dQ' % count, data[:count * 8])
+
+            return info._replace(**dict(zip(fields, values)))
+
+    return info
+
+
+def find_end_of_dir(file, offset=0):
+    '''
+    Finds the end of central directory record of the zip ``file`` merging in
+    the values of the zip64 end of central directory record when there is
+    one. ``offset`` is the position in the original zip file where ``file``
+    starts. Returns ``None`` if ``file`` does not look like a zip.
+    '''
+
+    try:
+        file.seek(-END_OF_DIR.size, 2)
+    except (IOError, ValueError):
+        # file too small, probably not a zip
+        return
+
+    position = file.tell()
+    eoa = END_OF_DIR.unpack(file.read())
+    if eoa.signature != END_OF_DIR.marker:
+        # there must be a comment
+        file.seek(max(position - 2 ** 16, 0))
+        position = file.tell()
+        tmp = file.read()
+        index = tmp.rfind(END_OF_DIR.marker)
+        if index < 0: return
+
+        position += index
+        eoa = END_OF_DIR.unpack(tmp[index:index + END_OF_DIR.size])
+
+    # the zip64 locator immediately precedes the end of central directory
+    if position < ZIP64_LOCATOR.size: return eoa
+
+    file.seek(position - ZIP64_LOCATOR.size)
+    locator = ZIP64_LOCATOR.unpack(file.read(ZIP64_LOCATOR.size))
+    if locator.signature != ZIP64_LOCATOR.marker: return eoa
+
+    file.seek(locator.offset - offset)
+    eoa64 = ZIP64_END_OF_DIR.unpack(file.read(ZIP64_END_OF_DIR.size))
+    if eoa64.signature != ZIP64_END_OF_DIR.marker: return eoa
+
+    return eoa._replace(disk_num=eoa64.disk_num,
+                        first_disk=eoa64.first_disk,
+                        local_entries=eoa64.local_entries,
+                        total_entries=eoa64.total_entries,
+                        directory_size=eoa64.directory_size,
+                        directory_offset=eoa64.directory_offset)
+
+
+def descriptor_struct(local_extra):
+    'Returns the data descriptor format used by a member'
+
+    # zip64 members (with the zip64 local extra field) have 64-bit sizes
+    if any(id == ZIP64_EXTRA_ID for id, _ in extra_fields(local_extra)):
+        return ZIP64_DATA_DESCRIPTOR
+
+    return DATA_DESCRIPTOR
+
+
+def _inflate(decompressor, data, size=CHUNK_SIZE):
+    'Yields ``data`` decompressed in pieces of at most ``size`` bytes'
+
+    while data:
+        yield decompressor.decompress(data, size)
+        data = decompressor.unconsumed_tail
+
+
+def _compressobj(settings):
+    level, mem_level, strategy = settings
+    return zlib.compressobj(level, zlib.DEFLATED, -15, mem_level, strategy)
+
+
+# data deflated to fingerprint the deflate settings, with runs of repeated
+# and of random looking bytes so the matching strategy shows
+_DEFLATE_PROBE = b''.join(sha1(struct.pack('<H', i % 251)).digest()[:i % 17] +
+                          struct.pack('<H', i * 7919 % 65521)
+                          for i in range(2 ** 13))
+_deflate_fingerprints = {}
+
+
+def deflate_fingerprint(settings):
+    '''
+    Returns the crc32 of a probe deflated with the (level, mem_level,
+    strategy) ``settings`` which changes if the zlib in use deflates
+    differently with them
+    '''
+
+    settings = tuple(settings)
+    if settings not in _deflate_fingerprints:
+        compressor = _compressobj(settings)
+        _deflate_fingerprints[settings] = zlib.crc32(
+                compressor.compress(_DEFLATE_PROBE) +
+                compressor.flush()) & 0xffffffff
+
+    return _deflate_fingerprints[settings]
+
+
+def recompression_size(format):
+    'Returns the size of the Recompression of a stream item of ``format``'
+
+    size = format.digest.recompression.size
+    if format.version >= 7: size += DEFLATE_FINGERPRINT.size
+
+    return size
 
-            eoa = END_OF_DIR.unpack(tmp[index:index + END_OF_DIR.size])
+
+def unpack_recompression(format, data):
+    '''
+    Returns the Recompression of a stream item of ``format`` from ``data``,
+    its fingerprint is None in stream files before version 7
+    '''
+
+    recompression = format.digest.recompression
+    fingerprint = None
+    if format.version >= 7:
+        fingerprint, = DEFLATE_FINGERPRINT.unpack(
+                data[recompression.size:
+                     recompression.size + DEFLATE_FINGERPRINT.size])
+
+    return Recompression._make(recompression.unpack(
+            data[:recompression.size]) + (fingerprint,))
+
+
+def recompress(chunks, settings, fingerprint=None):
+    '''
+    Yields the raw deflate stream ``chunks`` decompressed and deflated again
+    with the (level, mem_level, strategy) ``settings``. A ValueError is
+    raised before anything is yielded if the ``fingerprint`` of the settings
+    does not match the zlib in use.
+    '''
+
+    if fingerprint is not None and \
+            deflate_fingerprint(settings) != fingerprint:
+        raise ValueError('zlib %s does not deflate like the zlib which '
+                         'recompressed the member' % zlib.ZLIB_VERSION)
+
+    decompressor = zlib.decompressobj(-15)
+    compressor = _compressobj(settings)
+
+    for chunk in chunks:
+        for data in _inflate(decompressor, chunk):
+            output = compressor.compress(data)
+            if output: yield output
+
+    yield compressor.compress(decompressor.flush()) + compressor.flush()
+
+
+def _reproduces(file, size, settings):
+    '''
+    Checks if deflating the ``size`` bytes of deflate stream at the current
+    position of ``file`` again with ``settings`` gives back the same bytes
+    '''
+
+    decompressor = zlib.decompressobj(-15)
+    compressor = _compressobj(settings)
+
+    # the original bytes which were read but not produced yet (the output
+    # of a matching compressor never gets ahead of the input)
+    pending = b''
+    for chunk in read_chunks(file, size):
+        pending += chunk
+
+        # small pieces make a mismatch show up early
+        for data in _inflate(decompressor, chunk, 2 ** 14):
+            output = compressor.compress(data)
+            if output:
+                if pending[:len(output)] != output: return False
+                pending = pending[len(output):]
+
+    return (compressor.compress(decompressor.flush()) +
+            compressor.flush()) == pending
+
+
+# random values of the gear hash used to find chunk boundaries (derived from
+# sha1 so the boundaries never change)
+_GEAR = [struct.unpack('<L', sha1(struct.pack('<B', i)).digest()[:4])[0]
+         for i in range(256)]
+
+# the gear hash is computed for a block of bytes at once in a long integer
+# holding a lane per byte: a lane is wide enough for the sum of 32 shifted
+# gear values (69 bits) and is filled byte by byte with ``bytes.translate``
+_GEAR_PLANES = [bytes(bytearray((gear >> shift) & 0xff for gear in _GEAR))
+                for shift in (0, 8, 16, 24)]
+_LANE = 9
+_SCAN_BLOCK = 2 ** 16
+_scan_constants = {}
+
+try:
+    _from_bytes = int.from_bytes
+except AttributeError:
+    def _from_bytes(data, byteorder):
+        return int(hexlify(data[::-1]), 16) if data else 0
+
+
+def _repeat_lane(value, count):
+    'Returns a long integer holding ``value`` in ``count`` lanes'
+
+    key = value, count
+    if key not in _scan_constants:
+        # full blocks only use a few, but every last block its own
+        if len(_scan_constants) > 64: _scan_constants.clear()
+
+        lane = struct.pack('<Q', value) + b'\0' * (_LANE - 8)
+        _scan_constants[key] = _from_bytes(lane * count, 'little')
+
+    return _scan_constants[key]
+
+
+def _scan(data, skip, mask):
+    '''
+    Returns the index of the first byte of ``data`` (after ``skip`` bytes)
+    where the gear hash of ``data`` has the ``mask`` bits cleared, or None
+    '''
+
+    lanes = bytearray(len(data) * _LANE)
+    for i, plane in enumerate(_GEAR_PLANES):
+        lanes[i::_LANE] = data.translate(plane)
+    lanes = _from_bytes(bytes(lanes), 'little')
+
+    # each step adds the hash of the previous lanes, shifted by their count,
+    # so after five steps every lane holds the hash of up to 32 bytes
+    for step in range(5):
+        lanes += lanes << ((_LANE * 8 + 1) << step)
+
+    # masked values are 0 or at least the lowest mask bit, so adding the
+    # complement of that bit sets bit 32 of all but the cleared lanes
+    carry = _repeat_lane(1 << 32, len(data))
+    found = (lanes & _repeat_lane(mask, len(data))) + \
+        _repeat_lane((1 << 32) - (mask & -mask), len(data))
+    found = ((found & carry) ^ carry) >> (skip * _LANE * 8)
+    if not found: return None
+
+    return skip + ((found & -found).bit_length() - 33) // (_LANE * 8)
+
+
+def _cut(data, minimum, maximum, mask):
+    'Returns the length of the first content defined chunk of ``data``'
+
+    end = min(len(data), maximum)
+    offset = minimum
+    while offset < end:
+        # the hash only depends on the last 32 bytes, so a block starts with
+        # the (already checked) 31 bytes before it
+        start = max(offset - 31, minimum)
+        stop = min(offset + _SCAN_BLOCK, end)
+        index = _scan(data[start:stop], offset - start, mask)
+        if index is not None: return start + index + 1
+        offset = stop
+
+    return end
+
+
+def chunk_data(chunks, average=2 ** 20):
+    '''
+    Yields the byte strings ``chunks`` split in content defined chunks of
+    ``average`` bytes on average (and between a quarter and four times as
+    much). A boundary is found where the gear hash of the bytes after the
+    minimum size has its top bits cleared, so changing a few bytes only moves
+    the boundaries around them.
+    '''
+
+    minimum, maximum = average // 4, average * 4
+    bits = min(max((average - minimum).bit_length() - 1, 1), 31)
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    # the data is only joined once there is enough for the longest chunk
+    pending, size = [], 0
+    for data in chunks:
+        pending.append(data)
+        size += len(data)
+        if size < maximum: continue
+
+        buffer = b''.join(pending)
+        while len(buffer) >= maximum:
+            length = _cut(buffer, minimum, maximum, mask)
+            yield buffer[:length]
+            buffer = buffer[length:]
+        pending, size = [buffer], len(buffer)
+
+    buffer = b''.join(pending)
+    while buffer:
+        length = _cut(buffer, minimum, maximum, mask)
+        yield buffer[:length]
+        buffer = buffer[length:]
+
+
+def new_report(**values):
+    '''
+    Returns the counters filled in by ``process_zip`` and ``process_file``.
+    The ``*_seconds`` counters split the time spent hashing, doing data I/O
+    (reading members and writing data files), recompressing, chunking (with
+    its hashing and I/O) and everything else (parsing and writing the meta
+    data).
+    '''
+
+    report = dict.fromkeys(('archives', 'members', 'new_blobs',
+                            'existing_blobs', 'recompressed_members',
+                            'chunked_members', 'chunks', 'inline_members',
+                            'archive_bytes',
+                            'member_bytes', 'new_bytes', 'meta_bytes'), 0)
+    report.update(dict.fromkeys(('seconds', 'hash_seconds', 'io_seconds',
+                                 'recompress_seconds', 'chunk_seconds',
+                                 'meta_seconds'), 0.0))
+    report.update(values)
+    return report
+
+
+def merge_reports(reports):
+    'Sums archive reports into a report for the whole run'
+
+    total = new_report()
+    for report in reports: _add_report(total, report)
+
+    total['type'] = 'run'
+
+    return _finish_report(total)
+
+
+def _add_report(total, report):
+    'Adds the counters of ``report`` to the ``new_report`` ``total``'
+
+    for key in total:
+        total[key] += report[key]
+
+
+def _finish_report(report):
+    'Fills in the derived values of a report'
+
+    stored = report['new_bytes'] + report['meta_bytes']
+    report.update({
+        'stored_bytes': stored,
+        'saved_bytes': report['archive_bytes'] - stored,
+        'dedup_ratio': float(report['archive_bytes']) / max(stored, 1),
+        'bytes_per_second': report['archive_bytes'] /
+                            max(report['seconds'], 1e-9),
+    })
+
+    return report
+
+
+def read_chunks(file, size=None, report=None):
+    '''
+    Yields the next ``size`` bytes of ``file`` (all of it if ``None``) in
+    chunks of at most ``CHUNK_SIZE`` bytes, adding the time spent reading to
+    the ``io_seconds`` of ``report`` if given
+    '''
+
+    while size is None or size > 0:
+        start = timer()
+        chunk = file.read(CHUNK_SIZE if size is None
+                          else min(CHUNK_SIZE, size))
+        if report is not None: report['io_seconds'] += timer() - start
+        if not chunk: break
+
+        if size is not None: size -= len(chunk)
+        yield chunk
+
+
+def _compare(chunks, store, name):
+    'Checks that the data file ``name`` holds the byte strings ``chunks``'
+
+    with store.get(name) as data:
+        for chunk in chunks:
+            if data.read(len(chunk)) != chunk:
+                raise ValueError('digest collision with %s' % name)
+
+        if data.read(1):
+            raise ValueError('digest collision with %s' % name)
+
+
+def process_zip(filename, depth=0, base='.', digest='sha1',
+                recompress=False, chunk_threshold=None, chunk_size=2 ** 20,
+                compact=False, meta_base=None, store=None,
+                inline_threshold=None):
+    '''
+    Explodes the zip ``filename`` and returns its report (see
+    ``new_report``) or ``None`` if it is not a zip file. ``recompress``
+    deduplicates deflated members on their decompressed content when their
+    deflate stream can be reproduced, and members of at least
+    ``chunk_threshold`` bytes are stored in content defined chunks of
+    ``chunk_size`` bytes on average and members smaller than
+    ``inline_threshold`` bytes in the stream file. ``compact`` stores the
+    meta data in its
+    compact form, as differences from the exploded zip ``meta_base`` if
+    given (see ``compact_meta``). The data files go to the ``BlobStore``
+    ``store``, by default the ``data`` directory of ``base``.
+    '''
+
+    start = timer()
+    started = time.time()
+    if store is None: store = DirectoryStore(path.join(base, 'data'), depth)
+
+    with open(filename, 'rb') as file:
+        eoa = find_end_of_dir(file)
+        if eoa is None: return
+
+        file.seek(0, 2)
+        filesize = file.tell()
+        report = new_report(type='archive', archive=filename, archives=1,
+                            archive_bytes=filesize)
 
         for dir in ('meta', 'data'):
-            dir = path.join(base, dir)
-            if not path.isdir(dir): os.makedirs(dir)
+            _makedirs(path.join(base, dir))
 
-        prefix = path.join(base, 'meta', path.basename(filename))
-        with open(prefix + '.jump', 'wb') as jump:
-            with open(prefix + '.stream', 'wb') as stream:
-                with open(prefix + '.dir', 'wb') as dir:
+        # the meta files are written to temporary files and renamed once
+        # complete, so a running mount never sees a partial archive
+        name = path.basename(filename)
+        prefix = path.join(base, 'meta', name)
+        tmp = '.%d.tmp' % os.getpid()
+        with open(prefix + '.jump' + tmp, 'wb') as jump:
+            with open(prefix + '.stream' + tmp, 'wb') as stream:
+                with open(prefix + '.dir' + tmp, 'wb') as dir:
 
                     jump.write(JUMP_ITEM.pack(filesize, eoa.directory_offset))
+                    write_stream_header(stream, digest)
+
                     file.seek(eoa.directory_offset)
                     for _ in range(eoa.total_entries):
-                        info = file.read(CENTRAL_DIR.size)
-                        dir.write(info)
+                        raw_info = file.read(CENTRAL_DIR.size)
+                        info = CENTRAL_DIR.unpack(raw_info)
+                        var_fields = file.read(info.filename_len +
+                                               info.extra_field_len +
+                                               info.comment_len)
 
-                        info = CENTRAL_DIR.unpack(info)
+                        dir.write(raw_info)
+                        dir.write(var_fields)
+
+                        # large members store their sizes and offset in
+                        # the zip64 extra field
+                        info = zip64_info(info, var_fields[
+                                info.filename_len:
+                                info.filename_len + info.extra_field_len])
 
                         # write to the jump file a mapping from zip to
                         # stream location
                         jump.write(JUMP_ITEM.pack(info.offset, stream.tell()))
 
-                        process_file(file, info, stream,
-                                     depth=depth, base=base)
-
-                        dir.write(file.read(info.filename_len +
-                                  info.extra_field_len + info.comment_len))
+                        process_file(file, info, stream, depth=depth,
+                                     base=base, digest=digest, report=report,
+                                     recompress=recompress,
+                                     chunk_threshold=chunk_threshold,
+                                     chunk_size=chunk_size, store=store,
+                                     inline_threshold=inline_threshold)
 
                     # copy the rest of the file following the central
                     # directory items
                     dir.write(file.read())
 
+    if compact or meta_base:
+        # the first archive of a family is its own base
+        for suffix in ('.stream', '.dir'):
+            _compact_file(prefix + suffix + tmp, name, suffix, base,
+                          None if meta_base == name else meta_base)
+
+    # the mount lists the archives by their .dir file
+    _stamp_meta([prefix + suffix + tmp
+                 for suffix in ('.jump', '.stream', '.dir')])
+    exploded = path.exists(prefix + '.dir')
+    for suffix in ('.jump', '.stream', '.dir'):
+        os.rename(prefix + suffix + tmp, prefix + suffix)
+
+    # the versions kept while it was a base are only used by the archives
+    # based on it which were not exploded again since
+    if exploded: _prune_kept_bases(name, base, started)
 
-def process_file(file, info, stream, depth=0, base='.'):
+    report['meta_bytes'] = sum(os.path.getsize(prefix + suffix) for suffix in
+                               ('.jump', '.stream', '.dir'))
+    report['seconds'] = timer() - start
+    report['meta_seconds'] = max(report['seconds'] - report['hash_seconds'] -
+                                 report['io_seconds'] -
+                                 report['recompress_seconds'] -
+                                 report['chunk_seconds'], 0.0)
+
+    return _finish_report(report)
+
+
+def _recompress_member(file, size, digest, hexdigest, store, report):
+    '''
+    Stores the deflated member at the current position of ``file`` in the
+    data file of its canonical deflate stream if its own deflate stream can
+    be reproduced from it. Returns the ``Recompression`` or ``None`` if the
+    member has to be stored as is.
+    '''
+
+    offset = file.tell()
+    start = timer()
+
+    try:
+        # a canonical member (the most common) is stored as is
+        if _reproduces(file, size, CANONICAL_DEFLATE): return
+
+        for settings in DEFLATE_CANDIDATES:
+            if settings == CANONICAL_DEFLATE: continue
+
+            file.seek(offset)
+            if _reproduces(file, size, settings): break
+        else:
+            return
+
+        # write the canonical stream to a temporary file outside the store,
+        # its name is only known once it has been hashed
+        fd, tmp = tempfile.mkstemp(prefix='recompress.', suffix='.tmp')
+        canonical = digest.new()
+
+        file.seek(offset)
+        with os.fdopen(fd, 'wb') as d:
+            for chunk in recompress(read_chunks(file, size),
+                                    CANONICAL_DEFLATE):
+                canonical.update(chunk)
+                d.write(chunk)
+
+        data_name = canonical.hexdigest()
+        try:
+            if data_name == hexdigest:
+                return
+
+            elif store.exists(data_name):
+                report['existing_blobs'] += 1
+
+                if digest.verify:
+                    with open(tmp, 'rb') as d:
+                        _compare(iter(lambda: d.read(CHUNK_SIZE), b''),
+                                 store, data_name)
+
+            else:
+                report['new_blobs'] += 1
+                report['new_bytes'] += path.getsize(tmp)
+                store.put_file(data_name, tmp)
+        finally:
+            if path.exists(tmp): os.remove(tmp)
+
+        report['recompressed_members'] += 1
+        return Recompression(*(settings + (size, canonical.digest(),
+                                           deflate_fingerprint(settings))))
+    finally:
+        report['recompress_seconds'] += timer() - start
+
+
+def _store_chunks(file, size, digest, average, store, report):
+    '''
+    Stores the ``size`` bytes at the current position of ``file`` in content
+    defined chunks and returns the (length, digest) of each chunk
+    '''
+
+    start = timer()
+    chunks = []
+
+    for data in chunk_data(read_chunks(file, size), average):
+        hash = digest.new()
+        hash.update(data)
+        data_name = hash.hexdigest()
+
+        if store.exists(data_name):
+            report['existing_blobs'] += 1
+            if digest.verify: _compare([data], store, data_name)
+
+        else:
+            report['new_blobs'] += 1
+            report['new_bytes'] += len(data)
+            store.put(data_name, [data])
+
+        chunks.append((len(data), hash.digest()))
+
+    report['chunked_members'] += 1
+    report['chunks'] += len(chunks)
+    report['chunk_seconds'] += timer() - start
+
+    return chunks
+
+
+def process_file(file, info, stream, depth=0, base='.', digest='sha1',
+                 report=None, recompress=False, chunk_threshold=None,
+                 chunk_size=2 ** 20, store=None, inline_threshold=None):
     pos = file.tell()
+    digest = get_digest(digest)
+    if report is None: report = new_report()
+    if store is None: store = DirectoryStore(path.join(base, 'data'), depth)
 
     # go to the local header and unpack it
     file.seek(info.offset)
@@ -117,37 +1152,100 @@ def process_file(file, info, stream, depth=0, base='.'):
     var_fields = file.read(header.filename_len + header.extra_field_len)
 
     # header doesn't always have the size, so it's safer to use the central
-    # directory information
-    data = file.read(info.compressed_size)
+    # directory information (the data is hashed in chunks because it may be
+    # larger than memory)
+    data_offset = file.tell()
+    hash = digest.new()
+
+    io_seconds = report['io_seconds']
+    start = timer()
+    for chunk in read_chunks(file, info.compressed_size, report):
+        hash.update(chunk)
+    report['hash_seconds'] += (timer() - start -
+                               (report['io_seconds'] - io_seconds))
+
+    report['members'] += 1
+    report['member_bytes'] += info.compressed_size
 
-    sha = sha1(data)
-    digest = sha.hexdigest()
+    recompression = chunks = inline = None
+    stored = False
+    data_name = hash.hexdigest()
 
-    directory = path.join(*([base, 'data'] + list(digest[:depth])))
-    data_name = path.join(directory, digest)
-    if not path.isfile(data_name):
-        if not path.isdir(directory):
-            os.makedirs(directory)
+    # small members are not worth a data file (and opening it)
+    if inline_threshold is not None and \
+            info.compressed_size < inline_threshold:
+        file.seek(data_offset)
+        inline = file.read(info.compressed_size)
+        report['inline_members'] += 1
+        stored = True
 
-        with open(data_name, 'wb') as d:
-            d.write(data)
+    elif store.exists(data_name):
+        stored = True
+        report['existing_blobs'] += 1
+
+        # weak digests may collide, so make sure it's really the same data
+        if digest.verify:
+            file.seek(data_offset)
+            _compare(read_chunks(file, info.compressed_size, report), store,
+                     data_name)
+
+    elif chunk_threshold is not None and \
+            info.compressed_size >= chunk_threshold:
+        file.seek(data_offset)
+        chunks = _store_chunks(file, info.compressed_size, digest, chunk_size,
+                               store, report)
+        stored = True
+
+    elif recompress and header.compression == 8:
+        file.seek(data_offset)
+        recompression = _recompress_member(file, info.compressed_size,
+                                           digest, data_name, store, report)
+        stored = recompression is not None
+        file.seek(data_offset + info.compressed_size)
+
+    if not stored:
+        report['new_blobs'] += 1
+        report['new_bytes'] += info.compressed_size
+
+        file.seek(data_offset)
+        start = timer()
+        store.put(data_name, read_chunks(file, info.compressed_size))
+        report['io_seconds'] += timer() - start
 
     descriptor = b''
+    descriptor_format = descriptor_struct(var_fields[header.filename_len:])
 
     # check if there is a data descriptor here
     if file.read(len(DATA_DESCRIPTOR.marker)) == DATA_DESCRIPTOR.marker:
-        descriptor = DATA_DESCRIPTOR.marker + file.read(DATA_DESCRIPTOR.size)
+        descriptor = DATA_DESCRIPTOR.marker + \
+                file.read(descriptor_format.size)
 
     elif header.flag & 0b1000:
         file.seek(-len(DATA_DESCRIPTOR.marker), 1)
-        descriptor = file.read(DATA_DESCRIPTOR.size)
+        descriptor = file.read(descriptor_format.size)
 
     # the length of the descriptor allows us to not have to do the above logic
     # and the hex digest allows us to request the shared data to fill the
     # stream
-    stream.write(STREAM_ITEM.pack(*(header + (len(descriptor), sha.digest()))))
+    flags = ((recompression and ITEM_RECOMPRESSED) or
+             (chunks and ITEM_CHUNKED) or
+             (inline is not None and ITEM_INLINE) or 0)
+    stream.write(digest.stream_item.pack(*(header + (len(descriptor) | flags,
+                                                    hash.digest()))))
     stream.write(var_fields)
     if descriptor: stream.write(descriptor)
+    if recompression:
+        stream.write(digest.recompression.pack(*recompression[:5]) +
+                     DEFLATE_FINGERPRINT.pack(recompression.fingerprint))
+
+    if chunks:
+        stream.write(CHUNK_COUNT.pack(len(chunks)))
+        for chunk in chunks:
+            stream.write(digest.chunk.pack(*chunk))
+
+    if inline is not None:
+        stream.write(INLINE_LENGTH.pack(len(inline)))
+        stream.write(inline)
 
     file.seek(pos)
 
@@ -163,15 +1261,178 @@ parser.add_argument('-d', '--directory', metavar='DIR', default='.',
 parser.add_argument('--depth', type=int, default=0,
                     help='data subdirectory depth')
 
-parser.add_argument('filenames', metavar='FILE', nargs='+',
+parser.add_argument('--digest', choices=sorted(DIGESTS), default='sha1',
+                    help='digest used to name the data files')
+
+parser.add_argument('--recompress', action='store_true', default=False,
+                    help='deduplicate deflated members on their decompressed '
+                         'content when their deflate settings can be found')
+
+parser.add_argument('--chunk-threshold', metavar='BYTES', type=int,
+                    default=None, help='store members of at least BYTES in '
+                                       'content defined chunks')
+
+parser.add_argument('--chunk-size', metavar='BYTES', type=int,
+                    default=2 ** 20, help='average chunk size')
+
+parser.add_argument('--inline-threshold', metavar='BYTES', type=int,
+                    default=None, help='store members smaller than BYTES in '
+                                       'the stream file instead of a data '
+                                       'file')
+
+parser.add_argument('--compact-meta', action='store_true', default=False,
+                    help='compress the meta data')
+
+parser.add_argument('--meta-base', metavar='NAME', default=None,
+                    help='store the meta data as differences from the '
+                         'already exploded zip NAME (implies --compact-meta, '
+                         'requires Python 3.3 or later)')
+
+parser.add_argument('--report', metavar='FILE', default=None,
+                    help='write a JSON line per zip file and one for the run '
+                         'to FILE (- for stdout)')
+
+parser.add_argument('--progress', metavar='SECONDS', type=float, default=None,
+                    help='print a progress line to stderr every SECONDS')
+
+parser.add_argument('--watch', metavar='DIR', default=None,
+                    help='explode the zip files written to DIR until '
+                         'interrupted (Linux only)')
+
+parser.add_argument('--pattern', default='*.zip',
+                    help='zip files to explode in the watched directory '
+                         '(default: %(default)s)')
+
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of zip files exploded in parallel with '
+                         '--watch')
+
+parser.add_argument('--queue', type=int, default=8,
+                    help='most zip files waiting or being exploded with '
+                         '--watch, the others wait to be picked up')
+
+profiling.add_arguments(parser)
+
+parser.add_argument('filenames', metavar='FILE', nargs='*',
                     help='zip files to process')
 
 
+def _progress(totals, total, start):
+    run = merge_reports([totals])
+    elapsed = time.time() - start
+
+    sys.stderr.write('%s zips, %d members (%d new), %.1f MiB/s, '
+                     '%.1f MiB saved\n' %
+                     ('%d/%d' % (run['archives'], total) if total
+                      else run['archives'], run['members'],
+                      run['new_blobs'], run['archive_bytes'] / 2.0 ** 20 /
+                      max(elapsed, 1e-9), run['saved_bytes'] / 2.0 ** 20))
+
+
+def _process_zip(filename, options):
+    return process_zip(filename, **options)
+
+
+def _exploded(base):
+    'Returns a test of whether a zip was exploded after it was last written'
+
+    def exploded(filename):
+        try:
+            return (path.getmtime(path.join(base, 'meta',
+                                            path.basename(filename) + '.dir'))
+                    >= path.getmtime(filename))
+        except OSError:
+            return False
+
+    return exploded
+
+
+def _run(args):
+    if args.report == '-':
+        output = sys.stdout
+    elif args.report:
+        output = open(args.report, 'a')
+    else:
+        output = None
+
+    # the archive reports are only summed, a watch can run for ever
+    totals = new_report()
+    start = last_progress = time.time()
+    options = dict(depth=args.depth, base=args.directory, digest=args.digest,
+                   recompress=args.recompress,
+                   chunk_threshold=args.chunk_threshold,
+                   chunk_size=args.chunk_size,
+                   inline_threshold=args.inline_threshold,
+                   compact=args.compact_meta,
+                   meta_base=args.meta_base and path.basename(args.meta_base))
+
+    if args.watch:
+        # stop watching on SIGTERM as on ^C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        results = watch.watch(args.watch, _process_zip, (options,),
+                              pattern=args.pattern, jobs=args.jobs,
+                              queue=args.queue,
+                              done=_exploded(args.directory))
+    else:
+        results = ((filename, process_zip(filename, **options), None)
+                   for filename in args.filenames)
+
+    try:
+        for filename, report, error in results:
+            if error:
+                sys.stderr.write('%s: %s\n' % (filename, error))
+                continue
+            elif report is None:
+                continue
+
+            _add_report(totals, report)
+            if output:
+                output.write(json.dumps(report, sort_keys=True) + '\n')
+                output.flush()
+
+            if args.progress and \
+                    time.time() - last_progress >= args.progress:
+                _progress(totals, len(args.filenames), start)
+                last_progress = time.time()
+
+    except KeyboardInterrupt:
+        if not args.watch: raise
+
+    finally:
+        results.close()
+
+        if output:
+            run = merge_reports([totals])
+            run['seconds'] = time.time() - start
+            output.write(json.dumps(_finish_report(run),
+                                    sort_keys=True) + '\n')
+
+            if output is not sys.stdout: output.close()
+
+
 def main():
     args = parser.parse_args()
 
-    for filename in args.filenames:
-        process_zip(filename, depth=args.depth, base=args.directory)
+    if bool(args.watch) == bool(args.filenames):
+        parser.error('give either zip files or --watch DIR')
+
+    if args.meta_base:
+        try:
+            _meta_compressor(b'\0')
+        except ValueError as e:
+            parser.error(str(e))
+
+    profiler = profiling.from_args(args)
+    if profiler:
+        profiler.install_signal()
+        profiler.start()
+
+    try:
+        _run(args)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.dump()
 
 if __name__ == '__main__':
     main()
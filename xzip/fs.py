@@ -3,31 +3,53 @@
 
 import errno
 import fuse
+import json
 import os
 import signal
 import stat
+import sys
+import tempfile
 import threading
 import time
-import weakref
+import zlib
 
 from argparse import ArgumentParser
 from binascii import b2a_hex
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from fuse import FUSE, FuseOSError, LoggingMixIn, Operations
 from io import BufferedReader, BytesIO, FileIO, RawIOBase
 from os import path
 from struct import Struct
 
-__all__ = ('ZIP_STREAM_ITEM', 'DESCRIPTOR', 'STREAM_ITEM', 'JUMP_ITEM',
-           'HEADER_DIFF', 'Descriptor', 'ExplodedInfo', 'ExplodedZip', 'File',
-           'StreamItem', 'SeekTree',  'parser')
+from xzip import profiling
+from xzip.explode import (CHUNK_COUNT, CHUNK_SIZE, COMPACT_HEADER,
+                          DESCRIPTOR_LEN_MASK, DIGESTS, INLINE_LENGTH,
+                          ITEM_CHUNKED, ITEM_INLINE, ITEM_RECOMPRESSED,
+                          read_meta, read_stream_header, recompress,
+                          recompression_size, unpack_recompression)
+from xzip.metrics import Metrics, timer
+from xzip.store import CachedStore, DirectoryStore
+
+__all__ = ('ZIP_STREAM_ITEM', 'DESCRIPTOR', 'JUMP_ITEM', 'STATS_PATH',
+           'ChunkedData', 'Descriptor', 'ExplodedInfo', 'ExplodedZip', 'File',
+           'RecompressedCache', 'Root', 'StreamItem', 'SeekTree', 'parser')
 
 ZIP_STREAM_ITEM = Struct('<4s5H3L2H')
 DESCRIPTOR = Struct('<3L')
-STREAM_ITEM = Struct('<4s5H3L2HB20s')
 JUMP_ITEM = Struct('<2Q')
+
+# SHA-1 stream items only, the layout depends on the digest of the stream
+# file (see StreamFormat.digest)
+STREAM_ITEM = DIGESTS['sha1'].stream_item
 HEADER_DIFF = ZIP_STREAM_ITEM.size - STREAM_ITEM.size
 
+# virtual read only file with the metrics of the mount in JSON
+STATS_PATH = '/.xzip-stats'
+
+# the smallest advertised size of STATS_PATH, more than the metrics of every
+# operation with every latency bucket used take
+_STATS_SIZE = 2 ** 16
+
 Descriptor = namedtuple('Descriptor', 'crc compressed_size raw_size')
 StreamItem = namedtuple('StreamItem',
         ('signature', 'needed_version', 'flag', 'compression',
@@ -93,45 +115,361 @@ class SeekTree(object):
             return self.right.find(offset)
 
 
+class RecompressedCache(object):
+    '''
+    Keeps the original bytes of the most recently regenerated recompressed
+    members up to a total of ``size`` bytes
+    '''
+
+    def __init__(self, size=2 ** 26):
+        self.size = size
+        self.used = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.pop(key, None)
+            if data is not None: self.items[key] = data
+
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.items: return
+
+            self.items[key] = data
+            self.used += len(data)
+            while self.used > self.size:
+                _, evicted = self.items.popitem(last=False)
+                self.used -= len(evicted)
+
+
+class ChunkedData(RawIOBase):
+    '''
+    Reads the data files ``names`` of a member stored in chunks of
+    ``lengths`` bytes in ``store`` as a single file. Only the data file of
+    the chunk being read is kept open.
+    '''
+
+    def __init__(self, store, names, lengths):
+        super(ChunkedData, self).__init__()
+
+        self.store = store
+        self.names = names
+        self.offsets = []
+        self.length = 0
+        for length in lengths:
+            self.offsets.append(self.length)
+            self.length += length
+
+        self.tree = SeekTree.load((offset, index) for index, offset
+                                  in enumerate(self.offsets))
+        self.position = 0
+        self.index = None
+        self.chunk = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+
+        if offset < 0: raise ValueError('negative seek position')
+
+        self.position = offset
+        return offset
+
+    def readinto(self, b):
+        if self.position >= self.length: return 0
+
+        start, index = self.tree.find(self.position).location
+        if index != self.index:
+            if self.chunk: self.chunk.close()
+            self.chunk = self.store.get(self.names[index])
+            self.index = index
+
+        end = (self.offsets[index + 1] if index + 1 < len(self.offsets)
+               else self.length)
+
+        self.chunk.seek(self.position - start)
+        count = self.chunk.readinto(
+                memoryview(b)[:min(len(b), end - self.position)])
+
+        self.position += count
+        return count
+
+    def close(self):
+        if self.chunk:
+            self.chunk.close()
+            self.chunk = None
+
+        super(ChunkedData, self).close()
+
+
 def _unpack_stream(stream, struct):
     return (struct.unpack(item)
             for item in iter(lambda: stream.read(struct.size), b''))
 
-ExplodedInfo = namedtuple('ExplodedInfo',
-                          'filesize directory_offset jump_tree')
+# meta is None or the decoded (stream, dir) of compact meta files, and stamp
+# holds the (inode, modification time) of the .jump, .stream and .dir files
+# which tells when the archive was exploded again
+ExplodedInfo = namedtuple('ExplodedInfo', 'filesize directory_offset '
+                                          'jump_tree entries meta stamp')
+
+# how many times the meta files are opened while zipexplode is replacing
+# them, and how long the renames are given to complete
+_META_ATTEMPTS = 5
+_META_SETTLE = 0.05
+
+
+def _stamp(stat):
+    return stat.st_ino, stat.st_mtime
+
+# an exploded tree served by ExplodedZip (store is None for the data
+# directory of base)
+Root = namedtuple('Root', 'base depth store')
+
+# rough memory used by every entry of a jump tree (a leaf, its location and
+# on average one inner node)
+_ENTRY_SIZE = (2 * sys.getsizeof(SeekTree(None)) + sys.getsizeof((0, 0)) +
+               2 * sys.getsizeof(2 ** 40))
 
 class ExplodedZip(Operations):
-    'Create an E[x]ploded Zip FUSE handler'
-    def __init__(self, base='.', depth=0):
-        self.base = path.realpath(base)
-        self.depth = depth
+    '''
+    Create an E[x]ploded Zip FUSE handler
+
+    The archives of ``base`` are served at the top of the mount, or ``roots``
+    maps directory names to the ``Root`` of each exploded tree to serve in
+    them. The roots share the caches, metrics and open files of the mount.
+    '''
+
+    # a profiling.Profiler for the operations, set by main
+    profiler = None
+
+    def __init__(self, base='.', depth=0, recompressed_cache=2 ** 26,
+                 store=None, roots=None):
+        def root(base, depth, store):
+            base = path.realpath(base)
+            return Root(base, depth, store or
+                        DirectoryStore(path.join(base, 'data'), depth))
+
+        if roots is None:
+            self.root = root(base, depth, store)
+            self.roots = None
+        else:
+            for name in roots:
+                if not name or '/' in name or \
+                        name in ('.', '..', STATS_PATH[1:]):
+                    raise ValueError('invalid root name: %r' % name)
+
+            self.root = None
+            self.roots = dict((name, root(*value))
+                              for name, value in roots.items())
+
+        self.metrics = Metrics()
+        self.recompressed = RecompressedCache(recompressed_cache)
         self._load_time = time.time()
         self.__exploded_info = {}
         self.__handles = {}
         self.__fh = 0
         self.__fh_lock = threading.Lock()
+        self.__stats_size = 0
+
+    def __call__(self, op, *args):
+        start = timer()
+        error = True
+
+        try:
+            if self.profiler and self.profiler.wants(op):
+                result = self.profiler.call(
+                        op, super(ExplodedZip, self).__call__, op, *args)
+            else:
+                result = super(ExplodedZip, self).__call__(op, *args)
 
-    def _exploded_info(self, path):
+            error = False
+            return result
+        finally:
+            self.metrics.record(op, timer() - start, error)
+
+    def _exploded_info(self, path, reload=False):
         'Loads the jump list and file info into memory'
 
+        root, name = self._archive(path)
+        prefix = os.path.join(root.base, 'meta', name)
+
+        # zipexplode replaces the meta files when an archive is exploded
+        # again, starting with the .jump file
+        stamp = _stamp(os.stat(prefix + '.jump'))
+
         # safer with _reset and _release
         info = self.__exploded_info.get(path)
-        if info: return info
+        if info and info.stamp[0] == stamp and not reload:
+            self.metrics.increment('jump_cache_hits')
+            return info
+
+        self.metrics.increment('jump_cache_misses')
+        start = timer()
 
-        jump_name = os.path.join(self.base, 'meta',
-                                 os.path.basename(path) + '.jump')
+        files = self._open_meta(prefix)
+        try:
+            jump, stream, dir = files
+            stamp = tuple(_stamp(os.fstat(file.fileno())) for file in files)
 
-        with open(jump_name, 'rb') as jump:
+            entries = os.fstat(jump.fileno()).st_size // JUMP_ITEM.size - 1
             filesize, dir_offset = JUMP_ITEM.unpack(jump.read(JUMP_ITEM.size))
             tree = SeekTree.load(_unpack_stream(jump, JUMP_ITEM))
 
-            info = self.__exploded_info[path] = ExplodedInfo(filesize,
-                                                             dir_offset, tree)
+            # compact meta files are decoded once and served from memory
+            meta = None
+            if stream.read(len(COMPACT_HEADER.marker)) == \
+                    COMPACT_HEADER.marker:
+                stream.seek(0)
+                try:
+                    meta = (read_meta(name, '.stream', root.base,
+                                      stream.read()),
+                            read_meta(name, '.dir', root.base, dir.read()))
+                except (ValueError, zlib.error):
+                    raise FuseOSError(errno.EIO)
+        finally:
+            for file in files: file.close()
+
+        info = self.__exploded_info[path] = ExplodedInfo(filesize, dir_offset,
+                                                         tree, entries, meta,
+                                                         stamp)
+
+        self.metrics.record('jump_load', timer() - start)
+        return info
+
+    def _open_meta(self, prefix):
+        '''
+        Opens the .jump, .stream and .dir files of an archive. zipexplode
+        gives them the same modification time and renames them one after
+        the other, so they are opened again while they do not match.
+        '''
 
-            return info
+        suffixes = ('.jump', '.stream', '.dir')
+        for _ in range(_META_ATTEMPTS):
+            files = [open(prefix + suffix, 'rb') for suffix in suffixes]
+            stats = [os.fstat(file.fileno()) for file in files]
+            if len(set(stat.st_mtime for stat in stats)) == 1: return files
+
+            # the meta files of an older zipexplode never match, they are
+            # used once they are not being replaced
+            time.sleep(_META_SETTLE)
+            if [_stamp(os.stat(prefix + suffix)) for suffix in suffixes] == \
+                    [_stamp(stat) for stat in stats]:
+                return files
+
+            for file in files: file.close()
+
+        raise FuseOSError(errno.EAGAIN)
+
+    def _stats(self):
+        'Returns the metrics of the file system'
+
+        stats = self.metrics.snapshot()
+        counters = stats['counters']
+
+        # the totals of the closed files are merged with the open ones
+        served = [counters.pop('served_' + name, 0) for name in File.STATES]
+        blob_opens = counters.pop('blob_opens', 0)
+        handles = list(self.__handles.values())
+        for _, reader in handles:
+            raw = getattr(reader, 'raw', None)
+            if isinstance(raw, File):
+                served = [a + b for a, b in zip(served, raw.served)]
+                blob_opens += raw.blob_opens
+
+        hits = counters.get('jump_cache_hits', 0)
+        misses = counters.get('jump_cache_misses', 0)
+        infos = list(self.__exploded_info.values())
+
+        stats.update({
+            'bytes_served': dict(zip(File.STATES, served)),
+            'blob_opens': blob_opens,
+            'open_handles': len(handles),
+            'jump_cache': {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits and float(hits) / (hits + misses),
+                'loaded': len(infos),
+                'entries': sum(info.entries for info in infos),
+                'memory_bytes': sum(info.entries for info in infos) *
+                                _ENTRY_SIZE +
+                                sum(len(info.meta[0]) + len(info.meta[1])
+                                    for info in infos if info.meta),
+            },
+            'recompressed_cache': {
+                'entries': len(self.recompressed.items),
+                'bytes': self.recompressed.used,
+            },
+        })
+
+        # the roots of a mount share one cache
+        caches = [root.store for root in self._roots()
+                  if isinstance(root.store, CachedStore)]
+        if caches: stats['blob_cache'] = caches[0].stats()
+
+        return stats
+
+    def _stats_data(self, size=0):
+        'Returns the JSON metrics padded with spaces to ``size`` bytes'
+
+        stats = self._stats()
+        data = json.dumps(stats, indent=2, sort_keys=True).encode('ascii')
+
+        # the metrics grew past the size reported since, without the
+        # indentation they take about a third less
+        if size and len(data) >= size:
+            data = json.dumps(stats, sort_keys=True,
+                              separators=(',', ':')).encode('ascii')
+
+        return data + b' ' * (size - len(data) - 1) + b'\n'
+
+    def _roots(self):
+        return [self.root] if self.roots is None else list(self.roots.values())
+
+    def _split(self, path):
+        '''
+        Returns the ``Root`` serving ``path`` and the name of the archive
+        (``None`` for a directory, and no root for the top of a mount of
+        several roots)
+        '''
+
+        if self.roots is None:
+            return self.root, path[1:] or None
+
+        parts = path[1:].split('/', 1)
+        if not parts[0]: return None, None
+
+        root = self.roots.get(parts[0])
+        if root is None or (len(parts) > 1 and '/' in parts[1]):
+            raise FuseOSError(errno.ENOENT)
+
+        return root, parts[1] if len(parts) > 1 else None
+
+    def _archive(self, path):
+        root, name = self._split(path)
+        if name is None: raise FuseOSError(errno.EISDIR)
+
+        return root, name
+
+    def _is_dir(self, path):
+        return self._split(path)[1] is None
 
     def _metafiles(self, path):
-        meta = os.path.join(self.base, 'meta', os.path.basename(path))
+        root, name = self._archive(path)
+        meta = os.path.join(root.base, 'meta', name)
         return [meta + suffix for suffix in ('.dir', '.stream', '.jump')]
 
     @staticmethod
@@ -144,8 +482,15 @@ class ExplodedZip(Operations):
         with self.__fh_lock:
             if not self.__handles: self.__fh = 0
 
-        self.__exploded_info = \
-                dict(weakref.WeakValueDictionary(self.__exploded_info))
+            # the open files keep using their meta data
+            used = set(reader.raw.path
+                       for _, reader in self.__handles.values()
+                       if isinstance(getattr(reader, 'raw', None), File))
+
+        self.__exploded_info = dict(
+                (path, info)
+                for path, info in list(self.__exploded_info.items())
+                if path in used)
 
     def _reset(self):
         'Releases all meta data information'
@@ -158,7 +503,7 @@ class ExplodedZip(Operations):
     def access(self, path, amode):
         # this is a read only file system
         if amode & os.W_OK: return -errno.EACCES
-        if path == '/': return 0
+        if path == STATS_PATH or self._is_dir(path): return 0
 
         # as long as the user is able to access all of the meta files it's ok
         if all(os.access(f, amode) for f in self._metafiles(path)):
@@ -167,7 +512,7 @@ class ExplodedZip(Operations):
             return -errno.EACCES
 
     def chmod(self, path, mode):
-        if path == '/': return -errno.EACCES
+        if self._is_dir(path): return -errno.EACCES
 
         file_info = [(f, os.stat(f).st_mode) for f in self._metafiles(path)]
 
@@ -188,7 +533,7 @@ class ExplodedZip(Operations):
         return 0
 
     def chown(self, path, gid, uid):
-        if path == '/': return -errno.EACCES
+        if self._is_dir(path): return -errno.EACCES
 
         file_info = [(f, os.stat(f)) for f in self._metafiles(path)]
 
@@ -220,7 +565,30 @@ class ExplodedZip(Operations):
         self.__handles = {}
 
     def getattr(self, path, fh=None):
-        if path == '/':
+        if path == STATS_PATH:
+            uid, gid, pid = fuse.fuse_get_context()
+            now = time.time()
+
+            # the size is only known when the file is opened, so leave room
+            # for the metrics to double (open pads them to the advertised
+            # size). The size only changes once they did, so they still fit
+            # the previous size if the kernel has not seen the new one yet.
+            size = _STATS_SIZE
+            while size < 2 * len(self._stats_data()): size *= 2
+            self.__stats_size = max(size, self.__stats_size)
+
+            return {
+                'st_uid': uid,
+                'st_gid': gid,
+                'st_mode': stat.S_IFREG | 0444,
+                'st_size': self.__stats_size,
+                'st_nlink': 1,
+
+                'st_atime': now,
+                'st_mtime': now,
+                'st_ctime': now,
+            }
+        elif self._is_dir(path):
             uid, gid, pid = fuse.fuse_get_context()
 
             return {
@@ -265,13 +633,30 @@ class ExplodedZip(Operations):
         with self.__fh_lock:
             if not self.__handles: self.__fh = 0
 
-            raw = File(path, flags, self._exploded_info(path), fh=self.__fh,
-                       base=self.base, depth=self.depth)
+            if path == STATS_PATH:
+                reader = BytesIO(self._stats_data(self.__stats_size))
+            else:
+                root, _ = self._archive(path)
+                options = dict(fh=self.__fh, base=root.base,
+                               depth=root.depth, metrics=self.metrics,
+                               cache=self.recompressed, store=root.store)
+                try:
+                    file = File(path, flags, self._exploded_info(path),
+                                **options)
+                except OSError as e:
+                    if e.errno != errno.ESTALE: raise
+
+                    # the archive was exploded again since it was loaded
+                    file = File(path, flags,
+                                self._exploded_info(path, reload=True),
+                                **options)
 
-            self.__handles[self.__fh] = threading.Lock(), BufferedReader(raw)
+                reader = BufferedReader(file)
+
+            self.__handles[self.__fh] = threading.Lock(), reader
 
             self.__fh += 1
-            return raw.fh
+            return self.__fh - 1
 
     def read(self, path, size, offset, fh):
         lock, reader = self.__handles[fh]
@@ -281,12 +666,21 @@ class ExplodedZip(Operations):
             return reader.read(size)
 
     def readdir(self, path, fh):
-        if path != '/':
+        root, name = self._split(path)
+        if name is not None:
             raise FuseOSError(errno.ENOTDIR)
 
         yield '.'
         yield '..'
-        for entry in os.listdir(os.path.join(self.base, 'meta')):
+        if path == '/': yield STATS_PATH[1:]
+
+        # the top of a mount of several roots lists them
+        if root is None:
+            for name in sorted(self.roots):
+                yield name
+            return
+
+        for entry in os.listdir(os.path.join(root.base, 'meta')):
             if entry.endswith('.dir'):
                 yield os.path.basename(entry[:-4])
 
@@ -305,7 +699,15 @@ class ExplodedZip(Operations):
         return -errno.EINVAL
 
     def release(self, path, fh):
-        del self.__handles[fh]
+        lock, reader = self.__handles.pop(fh)
+        reader.close()
+
+        # keep the totals of the closed files
+        raw = getattr(reader, 'raw', None)
+        if isinstance(raw, File):
+            for name, served in zip(File.STATES, raw.served):
+                self.metrics.increment('served_' + name, served)
+            self.metrics.increment('blob_opens', raw.blob_opens)
 
     removexattr = _not_supported
     rename = _not_supported
@@ -313,7 +715,8 @@ class ExplodedZip(Operations):
 
     def statfs(self, path):
         # TODO: report better information
-        stat = os.statvfs(os.path.join(self.base, 'meta'))
+        root = self._split(path)[0] or self.roots[min(self.roots)]
+        stat = os.statvfs(os.path.join(root.base, 'meta'))
         return dict((key, getattr(stat, key)) for key in
                     ('f_bavail', 'f_bfree', 'f_blocks', 'f_bsize'))
 
@@ -332,6 +735,11 @@ class ExplodedZip(Operations):
     write = _not_supported
 
 
+def _hex(digest):
+    # I would think that b2a_hex should decode the raw bytes...
+    return b2a_hex(digest).decode('ascii')
+
+
 class File(RawIOBase):
     'Create a file object wrapping an e[x]ploded zip file'
 
@@ -339,13 +747,23 @@ class File(RawIOBase):
     DATA = 1
     DESCRIPTOR = 2
     DIRECTORY = 3
+    STATES = ('header', 'data', 'descriptor', 'directory')
 
-    def __init__(self, path, flags, info, fh=None, base='.', depth=0):
+    def __init__(self, path, flags, info, fh=None, base='.', depth=0,
+                 metrics=None, cache=None, store=None):
         super(File, self).__init__()
 
         self.path = path
         self.flags = flags
         self.fh = fh
+        self.metrics = metrics
+        self.cache = cache
+        self.store = store or DirectoryStore(os.path.join(base, 'data'),
+                                             depth)
+
+        # bytes read in each state and data files opened
+        self.served = [0, 0, 0, 0]
+        self.blob_opens = 0
 
         self.info = info
         self.depth = depth
@@ -358,21 +776,46 @@ class File(RawIOBase):
         self.zip_header = b''
         self.descriptor = b''
 
-        # data file info
+        # data file info (members which were recompressed are regenerated
+        # from the data file and checked against their digest, chunked
+        # members are read from the data file of each chunk and inline
+        # members from the stream item)
         self.data = None
         self.data_name = ''
         self.data_len = 0
+        self.digest = b''
+        self.recompression = None
+        self.chunks = None
+        self.inline = None
 
         # streams
         prefix = os.path.join(base, 'meta', os.path.basename(path))
-        self.stream = FileIO(prefix + '.stream', 'rb')
-        self.dir = FileIO(prefix + '.dir', 'rb')
-        self.data_dir = os.path.join(base, 'data')
+        if info.meta:
+            self.stream = BytesIO(info.meta[0])
+            self.dir = BytesIO(info.meta[1])
+        else:
+            self.stream = FileIO(prefix + '.stream', 'rb')
+            self.dir = FileIO(prefix + '.dir', 'rb')
+
+            if (_stamp(os.fstat(self.stream.fileno())),
+                    _stamp(os.fstat(self.dir.fileno()))) != info.stamp[1:]:
+                self.stream.close()
+                self.dir.close()
+                raise OSError(errno.ESTALE, 'the meta files of %s were '
+                                            'replaced' % path)
 
         # init
-        self._load_stream_item()
+        self.format = read_stream_header(self.stream)
+        self.stream_offset = self.stream.tell()
         self.lock = threading.Lock()
 
+        if info.directory_offset:
+            self._load_stream_item()
+        else:
+            # no members, everything is central directory
+            self.state = File.DIRECTORY
+            self.stream_offset = None
+
     def _load_stream_item(self):
         'Sets the next stream item as current.'
 
@@ -382,27 +825,112 @@ class File(RawIOBase):
 
         # open the header so we can know the data file to open, and the
         # length of the var fields
-        raw_header = self.stream.read(STREAM_ITEM.size)
-        header = StreamItem._make(STREAM_ITEM.unpack(raw_header))
+        stream_item = self.format.digest.stream_item
+        raw_header = self.stream.read(stream_item.size)
+        header = StreamItem._make(stream_item.unpack(raw_header))
 
         var_fields = header.filename_len + header.extra_field_len
-        # I would think that b2a_hex should decode the raw bytes...
-        sha1 = b2a_hex(header.sha).decode('ascii')
 
         # only save the zip part of the header
-        self.zip_header = (raw_header[:HEADER_DIFF] +
+        self.zip_header = (raw_header[:ZIP_STREAM_ITEM.size] +
                            self.stream.read(var_fields))
 
-        self.descriptor = self.stream.read(header.descriptor_len)
-
-        self.data_name = path.join(*([self.data_dir] +
-                                     list(sha1[:self.depth]) + [sha1]))
+        self.descriptor = self.stream.read(header.descriptor_len &
+                                           DESCRIPTOR_LEN_MASK)
+        self.digest = header.sha
+
+        self.recompression = None
+        if header.descriptor_len & ITEM_RECOMPRESSED:
+            self.recompression = unpack_recompression(
+                    self.format, self.stream.read(
+                        recompression_size(self.format)))
+
+        self.chunks = None
+        if header.descriptor_len & ITEM_CHUNKED:
+            chunk = self.format.digest.chunk
+            count, = CHUNK_COUNT.unpack(self.stream.read(CHUNK_COUNT.size))
+            chunks = self.stream.read(count * chunk.size)
+            self.chunks = [chunk.unpack(chunks[i:i + chunk.size])
+                           for i in range(0, len(chunks), chunk.size)]
+
+        self.inline = None
+        if header.descriptor_len & ITEM_INLINE:
+            length, = INLINE_LENGTH.unpack(
+                    self.stream.read(INLINE_LENGTH.size))
+            self.inline = self.stream.read(length)
+
+        self.data_name = _hex(self.recompression.digest
+                              if self.recompression else header.sha)
 
     def _open_data_file(self):
-        self.data = FileIO(self.data_name, 'rb')
-        self.data_len = self.data.seek(0, 2)
+        if self.inline is not None:
+            self.data = BytesIO(self.inline)
+            self.data_len = len(self.inline)
+            return
+
+        start = timer()
+
+        if self.recompression:
+            self.data = self._regenerate()
+        elif self.chunks:
+            self.data = ChunkedData(self.store, [_hex(digest) for _, digest
+                                                 in self.chunks],
+                                    [length for length, _ in self.chunks])
+        else:
+            self.data = self.store.get(self.data_name)
+
+        self.data.seek(0, 2)
+        self.data_len = self.data.tell()
         self.data.seek(0)
 
+        self.blob_opens += 1
+        if self.metrics: self.metrics.record('blob_open', timer() - start)
+
+    def _regenerate(self):
+        'Returns a file with the original bytes of a recompressed member'
+
+        data = self.cache and self.cache.get(self.digest)
+        if data is not None:
+            if self.metrics: self.metrics.increment('recompressed_cache_hits')
+            return BytesIO(data)
+
+        start = timer()
+        hash = self.format.digest.new()
+
+        # members which would not be kept by the cache go to disk
+        if self.cache and self.recompression.compressed_size <= \
+                self.cache.size:
+            output = BytesIO()
+        else:
+            output = tempfile.TemporaryFile()
+
+        try:
+            with self.store.get(self.data_name) as blob:
+                for chunk in recompress(iter(lambda: blob.read(CHUNK_SIZE),
+                                             b''), self.recompression[:3],
+                                        self.recompression.fingerprint):
+                    hash.update(chunk)
+                    output.write(chunk)
+        except ValueError as e:
+            output.close()
+            raise OSError(errno.EIO, 'unable to regenerate %s: %s' %
+                                     (self.data_name, e))
+
+        if hash.digest() != self.digest:
+            output.close()
+            raise OSError(errno.EIO, 'regenerating %s did not give back the '
+                                     'original data' % self.data_name)
+
+        if isinstance(output, BytesIO) and self.cache:
+            self.cache.put(self.digest, output.getvalue())
+
+        if self.metrics:
+            self.metrics.increment('recompressed_cache_misses')
+            self.metrics.record('recompress', timer() - start)
+
+        output.seek(0)
+        return output
+
     def close(self):
         self.stream.close()
         self.dir.close()
@@ -425,6 +953,7 @@ class File(RawIOBase):
 
             result = self.zip_header[previous_offset:self.offset]
             self.cursor += len(result)
+            self.served[state] += len(result)
 
             if self.offset >= len(self.zip_header):
                 self.state = File.DATA
@@ -435,6 +964,7 @@ class File(RawIOBase):
         elif state == File.DATA:
             result = self.data.read(count)
             self.cursor += len(result)
+            self.served[state] += len(result)
 
             if self.data.tell() >= self.data_len:
                 self.state = File.DESCRIPTOR
@@ -451,6 +981,7 @@ class File(RawIOBase):
 
             result = self.descriptor[previous_offset:self.offset]
             self.cursor += len(result)
+            self.served[state] += len(result)
 
             if self.offset >= len(self.descriptor):
                 if self.cursor >= self.info.directory_offset:
@@ -475,6 +1006,7 @@ class File(RawIOBase):
         elif state == File.DIRECTORY:
             result = self.dir.read(count)
             self.cursor += len(result)
+            self.served[state] += len(result)
 
             return result
         else:
@@ -498,6 +1030,7 @@ class File(RawIOBase):
             read = current_offset - previous_offset
             b[:read] = self.zip_header[previous_offset:current_offset]
             self.cursor += read
+            self.served[state] += read
 
             if current_offset == header_len:
                 self.state = File.DATA
@@ -508,6 +1041,7 @@ class File(RawIOBase):
         elif state == File.DATA:
             read = self.data.readinto(b)
             self.cursor += read
+            self.served[state] += read
 
             if self.data.tell() >= self.data_len:
                 self.state = File.DESCRIPTOR
@@ -528,6 +1062,7 @@ class File(RawIOBase):
             read = current_offset - previous_offset
             b[:read] = self.descriptor[previous_offset:current_offset]
             self.cursor += read
+            self.served[state] += read
 
             if current_offset == descriptor_len:
                 if self.cursor >= self.info.directory_offset:
@@ -552,6 +1087,7 @@ class File(RawIOBase):
         elif state == File.DIRECTORY:
             read = self.dir.readinto(b)
             self.cursor += read
+            self.served[state] += read
 
             return read
         else:
@@ -592,6 +1128,9 @@ class File(RawIOBase):
         if additional < header_len:
             self.state = File.HEADER
             self.offset = additional
+
+            # the data file may have been read already
+            if self.data: self.data.seek(0)
             return pos
 
         # assume currently in the data file
@@ -636,12 +1175,37 @@ parser.add_argument('-f', '--foreground', action='store_true', default=False,
 parser.add_argument('-s', '--single-threaded', action='store_true',
                     default=False, help='do not run in multi-threaded mode')
 
+parser.add_argument('--recompressed-cache', metavar='MIB', type=int,
+                    default=64, help='memory used to keep regenerated '
+                                     'recompressed members')
+
+parser.add_argument('--cache', metavar='DIR', default=None,
+                    help='copy the data files read to DIR (on a faster '
+                         'disk) and read them from there')
+
+parser.add_argument('--cache-size', metavar='MIB', type=int, default=1024,
+                    help='size of the data file cache')
+
+parser.add_argument('--root', metavar='NAME=DIR[:DEPTH]', action='append',
+                    default=None, help='serve the exploded files in DIR '
+                                       '(with the data subdirectory depth '
+                                       'DEPTH, --depth by default) in the '
+                                       'directory NAME, may be repeated '
+                                       'instead of giving a directory')
+
+parser.add_argument('--stats-dump', metavar='FILE', default=None,
+                    help='write the metrics of the mount to FILE on SIGUSR1 '
+                         '(they are always available in %s)' % STATS_PATH)
+
+profiling.add_arguments(parser, operations=True)
+
 parser.add_argument('-o', action='append', metavar='OPTIONS', default=None,
                     help='''"traditional" mount style options
                             (high priorty, but full spelling required),
                             --single-threaded -> nothread''')
 
-parser.add_argument('directory', help='base for the exploded files')
+parser.add_argument('directory', nargs='?',
+                    help='base for the exploded files')
 parser.add_argument('mount', help='mount point')
 
 def parse_o_options(options):
@@ -653,6 +1217,21 @@ def parse_o_options(options):
 
         yield k, v
 
+def parse_root(value, depth=0):
+    'Returns the name, directory and depth of a ``NAME=DIR[:DEPTH]`` root'
+
+    try:
+        name, directory = value.split('=', 1)
+    except ValueError:
+        raise ValueError('expected NAME=DIR[:DEPTH]: %s' % value)
+
+    # the directory may contain colons
+    head, _, tail = directory.rpartition(':')
+    if head and tail.isdigit():
+        directory, depth = head, int(tail)
+
+    return name, directory, depth
+
 def main():
     'mounts an e[x]ploded zip file system'
 
@@ -663,14 +1242,84 @@ def main():
     if 'debug' in opts: args.debug = True
     if 'foreground' in opts: args.foreground = True
     if 'nothread' in opts: args.single_threaded = True
-
-    operations = ExplodedZip(base=args.directory, depth=args.depth)
+    if 'stats_dump' in opts: args.stats_dump = opts['stats_dump']
+    if 'recompressed_cache' in opts:
+        args.recompressed_cache = int(opts['recompressed_cache'])
+    if 'profile' in opts: args.profile = opts['profile']
+    if 'profile_mode' in opts: args.profile_mode = opts['profile_mode']
+    if 'cache' in opts: args.cache = opts['cache']
+    if 'cache_size' in opts: args.cache_size = int(opts['cache_size'])
+
+    if bool(args.directory) == bool(args.root):
+        parser.error('give either a directory or --root NAME=DIR')
+
+    try:
+        roots = [parse_root(value, args.depth) for value in args.root or ()]
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not roots: roots = [(None, args.directory, args.depth)]
+    if len(set(name for name, _, _ in roots)) != len(roots):
+        parser.error('root names must be unique')
+
+    # the roots read their data files through a single cache
+    cache = None
+    stores = {}
+    for name, directory, depth in roots:
+        if not args.cache: break
+
+        # FUSE changes the working directory when it daemonizes
+        remote = DirectoryStore(path.join(path.realpath(directory), 'data'),
+                                depth)
+        if cache is None:
+            stores[name] = cache = CachedStore(remote,
+                                               path.abspath(args.cache),
+                                               args.cache_size * 2 ** 20,
+                                               args.depth)
+        else:
+            stores[name] = cache.share(remote)
+
+    recompressed_cache = args.recompressed_cache * 2 ** 20
+    try:
+        if args.directory:
+            operations = ExplodedZip(base=args.directory, depth=args.depth,
+                                     recompressed_cache=recompressed_cache,
+                                     store=stores.get(None))
+        else:
+            operations = ExplodedZip(recompressed_cache=recompressed_cache,
+                                     roots=dict((name, Root(directory, depth,
+                                                            stores.get(name)))
+                                                for name, directory, depth
+                                                in roots))
+    except ValueError as e:
+        parser.error(str(e))
 
     def release(*_): operations._release()
     signal.signal(signal.SIGHUP, release)
 
-    fuse = FUSE(operations, args.mount, foreground=args.foreground,
-                ro=True, debug=args.debug, nothreads=args.single_threaded)
+    if args.stats_dump:
+        # FUSE changes the working directory when it daemonizes
+        stats_dump = path.abspath(args.stats_dump)
+
+        def dump(*_):
+            with open(stats_dump, 'wb') as output:
+                output.write(operations._stats_data())
+
+        signal.signal(signal.SIGUSR1, dump)
+
+    profiler = profiling.from_args(args)
+    if profiler:
+        # only the operations are profiled, not the idle FUSE loop
+        operations.profiler = profiler
+        profiler.install_signal()
+
+    try:
+        fuse = FUSE(operations, args.mount, foreground=args.foreground,
+                    ro=True, debug=args.debug, nothreads=args.single_threaded)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.dump()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import errno
+import os
+import sys
+import zlib
+
+from argparse import ArgumentParser
+from binascii import b2a_hex
+from io import BytesIO, UnsupportedOperation
+from multiprocessing import Pool
+from os import path
+
+from xzip.explode import (CENTRAL_DIR, CHUNK_COUNT, DESCRIPTOR_LEN_MASK,
+                          INLINE_LENGTH, ITEM_CHUNKED, ITEM_INLINE,
+                          ITEM_RECOMPRESSED, JUMP_ITEM, LOCAL_HEADER,
+                          open_meta, read_stream_header, recompress,
+                          recompression_size, unpack_recompression,
+                          zip64_info)
+from xzip.store import DirectoryStore
+
+__all__ = ('CHUNK_SIZE', 'copy_blob', 'implode', 'parser')
+
+CHUNK_SIZE = 2 ** 20
+
+# errors which mean the zero copy call is not supported for the given files
+_UNSUPPORTED = set((errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                    getattr(errno, 'EOPNOTSUPP', errno.ENOSYS),
+                    getattr(errno, 'ENOTSUP', errno.ENOSYS),
+                    getattr(errno, 'ENOTSOCK', errno.ENOSYS)))
+
+
+def _copy_file_range(src, dst, count):
+    return os.copy_file_range(src, dst, count)
+
+def _sendfile(src, dst, count):
+    return os.sendfile(dst, src, None, count)
+
+def _read_write(src, dst, count):
+    data = os.read(src, min(count, CHUNK_SIZE))
+    if data: os.write(dst, data)
+    return len(data)
+
+# sendfile only copies between regular files on Linux, elsewhere the output
+# has to be a socket (and the offset an int)
+_COPIES = [copy for name, copy in (('copy_file_range', _copy_file_range),
+                                   ('sendfile', _sendfile))
+           if hasattr(os, name) and (name != 'sendfile' or
+                                     sys.platform.startswith('linux'))] + \
+          [_read_write]
+
+
+def copy_blob(src, dst, count):
+    '''
+    Copies ``count`` bytes from the current position of the file descriptor
+    ``src`` to the file descriptor ``dst`` without passing through user space
+    when the kernel supports it.
+    '''
+
+    copies = _COPIES
+    while count > 0:
+        try:
+            copied = copies[0](src, dst, count)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or len(copies) == 1: raise
+
+            # fall back to the next best method for the rest of the blob
+            copies = copies[1:]
+            continue
+
+        if not copied:
+            raise IOError(errno.EIO, 'blob is truncated')
+
+        count -= copied
+
+
+def _open_blobs(blobs, store):
+    '''
+    Yields a file opened from ``store`` on each blob (pairs of byte count and
+    digest) and its byte count in turn, only one blob is open at a time
+    '''
+
+    for length, digest in blobs:
+        with store.get(b2a_hex(digest).decode('ascii')) as src:
+            yield src, length
+
+
+def _read_blobs(blobs):
+    'Yields the data of the blobs (pairs of file and byte count)'
+
+    for src, count in blobs:
+        while count > 0:
+            data = src.read(min(count, CHUNK_SIZE))
+            if not data:
+                raise IOError(errno.EIO, 'blob is truncated')
+
+            count -= len(data)
+            yield data
+
+
+def _copy_blob_file(src, dst, count):
+    'Copies ``count`` bytes of the blob file ``src`` to ``dst``'
+
+    try:
+        fd = src.fileno()
+    except (AttributeError, UnsupportedOperation):
+        # not backed by a local file, e.g. a remote store
+        for data in _read_blobs([(src, count)]):
+            os.write(dst, data)
+    else:
+        copy_blob(fd, dst, count)
+
+
+def _copy_verified(chunks, dst, compression, crc):
+    'Writes the byte strings ``chunks`` of a member checking its CRC'
+
+    decompress = compression == 8 and zlib.decompressobj(-15).decompress
+    actual = 0
+
+    for data in chunks:
+        os.write(dst, data)
+
+        if compression in (0, 8):
+            actual = zlib.crc32(decompress(data) if decompress else data,
+                                actual)
+
+    if compression in (0, 8) and actual & 0xffffffff != crc:
+        raise ValueError('CRC %08x does not match %08x' %
+                         (actual & 0xffffffff, crc))
+
+
+def _copy_recompressed(src, dst, recompression, digest, expected):
+    '''
+    Writes the original bytes of a recompressed member regenerated from its
+    data file, checking them against the ``expected`` digest of the stream
+    item
+    '''
+
+    hash = digest.new()
+    count = 0
+    for data in recompress(iter(lambda: src.read(CHUNK_SIZE), b''),
+                           recompression[:3], recompression.fingerprint):
+        hash.update(data)
+        os.write(dst, data)
+        count += len(data)
+
+    if hash.digest() != expected or count != recompression.compressed_size:
+        raise ValueError('regenerated member does not match the original')
+
+
+def implode(name, output, base='.', depth=0, verify=False, store=None):
+    '''
+    Rebuilds the original zip file ``name`` from its meta tuple and the
+    shared data files in ``store`` (by default the ``data`` directory of
+    ``base``), writing it to ``output``. If ``verify`` is set the CRC of each
+    member is checked as it is written (recompressed members are always
+    checked against their digest).
+    '''
+
+    if store is None: store = DirectoryStore(path.join(base, 'data'), depth)
+
+    prefix = path.join(base, 'meta', name)
+    with open(prefix + '.jump', 'rb') as jump:
+        filesize, directory_offset = JUMP_ITEM.unpack(
+                jump.read(JUMP_ITEM.size))
+        entries = (os.fstat(jump.fileno()).st_size // JUMP_ITEM.size) - 1
+
+    # write to a temporary file so a partial zip is never left behind
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    dst = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+    try:
+        with open_meta(name, '.stream', base) as stream:
+            with open_meta(name, '.dir', base) as dir:
+                stream_format = read_stream_header(stream)
+                digest_format = stream_format.digest
+                stream_item = digest_format.stream_item
+
+                for _ in range(entries):
+                    raw_header = stream.read(stream_item.size)
+                    header = stream_item.unpack(raw_header)
+                    filename_len, extra_field_len, item_flags, digest = \
+                            header[-4:]
+                    descriptor_len = item_flags & DESCRIPTOR_LEN_MASK
+
+                    info = CENTRAL_DIR.unpack(dir.read(CENTRAL_DIR.size))
+                    var_fields = dir.read(info.filename_len +
+                                          info.extra_field_len +
+                                          info.comment_len)
+                    info = zip64_info(info, var_fields[
+                            info.filename_len:
+                            info.filename_len + info.extra_field_len])
+
+                    # the local header and the var fields go out in a single
+                    # write followed by the blob and the descriptor
+                    os.write(dst, raw_header[:LOCAL_HEADER.size] +
+                                  stream.read(filename_len + extra_field_len))
+                    descriptor = stream.read(descriptor_len)
+
+                    recompression = None
+                    if item_flags & ITEM_RECOMPRESSED:
+                        recompression = unpack_recompression(
+                                stream_format, stream.read(
+                                    recompression_size(stream_format)))
+
+                    # inline members are copied from the stream item and
+                    # chunked members from the data file of each chunk
+                    inline = None
+                    if item_flags & ITEM_INLINE:
+                        length, = INLINE_LENGTH.unpack(
+                                stream.read(INLINE_LENGTH.size))
+                        inline = stream.read(length)
+                        if len(inline) != info.compressed_size:
+                            raise ValueError('inline member does not match '
+                                             'the member size')
+                        blobs = []
+
+                    elif item_flags & ITEM_CHUNKED:
+                        chunk = digest_format.chunk
+                        count, = CHUNK_COUNT.unpack(
+                                stream.read(CHUNK_COUNT.size))
+                        blobs = [chunk.unpack(stream.read(chunk.size))
+                                 for _ in range(count)]
+                        if sum(length for length, _ in blobs) != \
+                                info.compressed_size:
+                            raise ValueError('chunks do not add up to the '
+                                             'member size')
+                    else:
+                        blobs = [(info.compressed_size,
+                                  recompression.digest if recompression
+                                  else digest)]
+
+                    srcs = _open_blobs(blobs, store)
+                    try:
+                        if recompression:
+                            _copy_recompressed(next(srcs)[0], dst,
+                                               recompression, digest_format,
+                                               digest)
+                        elif verify:
+                            _copy_verified([inline] if inline is not None
+                                           else _read_blobs(srcs), dst,
+                                           info.compression, info.crc)
+                        elif inline is not None:
+                            os.write(dst, inline)
+                        else:
+                            for src, length in srcs:
+                                _copy_blob_file(src, dst, length)
+                    finally:
+                        srcs.close()
+
+                    if descriptor: os.write(dst, descriptor)
+
+                # compact meta files were decoded in memory
+                if isinstance(dir, BytesIO):
+                    os.write(dst, dir.getvalue())
+                else:
+                    os.lseek(dir.fileno(), 0, os.SEEK_SET)
+                    copy_blob(dir.fileno(), dst, filesize - directory_offset)
+
+        if os.lseek(dst, 0, os.SEEK_CUR) != filesize:
+            raise ValueError('rebuilt %d bytes, expected %d' %
+                             (os.lseek(dst, 0, os.SEEK_CUR), filesize))
+    except:
+        os.close(dst)
+        os.unlink(tmp)
+        raise
+
+    os.close(dst)
+    os.rename(tmp, output)
+
+
+
+
+parser = ArgumentParser(description='Rebuilds the original zip files from '
+                                    'their exploded format.')
+
+parser.add_argument('-d', '--directory', metavar='DIR', default='.',
+                    help='base of the exploded files')
+
+parser.add_argument('--depth', type=int, default=0,
+                    help='data subdirectory depth')
+
+parser.add_argument('-o', '--output', metavar='DIR', default='.',
+                    help='directory to write the zip files to')
+
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='number of zip files to rebuild in parallel')
+
+parser.add_argument('--verify', action='store_true', default=False,
+                    help='check the CRC of every member while copying')
+
+parser.add_argument('names', metavar='NAME', nargs='*',
+                    help='exploded zip names to rebuild (default: all)')
+
+
+def _implode(args):
+    name, output, base, depth, verify = args
+
+    try:
+        implode(name, output, base=base, depth=depth, verify=verify)
+    except (IOError, OSError, ValueError, zlib.error) as e:
+        return name, str(e)
+
+    return name, None
+
+
+def main():
+    args = parser.parse_args()
+
+    names = args.names or sorted(
+            entry[:-4] for entry in os.listdir(path.join(args.directory,
+                                                         'meta'))
+            if entry.endswith('.dir'))
+
+    items = [(name, path.join(args.output, path.basename(name)),
+              args.directory, args.depth, args.verify) for name in names]
+
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap_unordered(_implode, items)
+    else:
+        pool = None
+        results = (_implode(item) for item in items)
+
+    failed = 0
+    for name, error in results:
+        if error:
+            sys.stderr.write('%s: %s\n' % (name, error))
+            failed += 1
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
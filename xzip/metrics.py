@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import threading
+import time
+
+from collections import defaultdict
+
+__all__ = ('timer', 'Histogram', 'Metrics')
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    '''
+    Counts latencies in power of two microsecond buckets (bucket ``i`` holds
+    the latencies below ``2 ** i`` microseconds)
+    '''
+
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 32
+
+    def record(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+        if error: self.errors += 1
+
+        bucket = min(int(seconds * 1000000).bit_length(), 31)
+        self.buckets[bucket] += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.count and self.total * 1000 / self.count,
+            'max_ms': self.max * 1000,
+            'histogram_us': dict(('lt_%d' % (2 ** i), count)
+                                 for i, count in enumerate(self.buckets)
+                                 if count),
+        }
+
+
+class Metrics(object):
+    'Thread safe latency histograms and counters'
+
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+
+    def record(self, name, seconds, error=False):
+        with self.lock:
+            self.latencies[name].record(seconds, error)
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.start,
+                'latencies': dict((name, histogram.snapshot()) for
+                                  name, histogram in self.latencies.items()),
+                'counters': dict(self.counters),
+            }
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from os import path
+
+__all__ = ('MODES', 'Profiler', 'add_arguments', 'from_args')
+
+MODES = ('cprofile', 'sample')
+
+# since Python 3.12 a profile records every thread and only one can be
+# enabled at a time, so the profiled calls share one
+_SHARED_PROFILE = sys.version_info >= (3, 12)
+
+
+class Profiler(object):
+    '''
+    Profiles code with ``cProfile`` (written as ``pstats`` data) or by
+    sampling the stacks of the running threads every ``interval`` seconds
+    (written as collapsed stacks, one ``frame;frame;... count`` line per
+    stack, as used by flame graph tools).
+
+    Either the whole run is profiled between ``start`` and ``stop``, or
+    single calls are profiled with ``call`` (``operations`` restricts which
+    ones, see ``wants``).
+    '''
+
+    def __init__(self, filename, mode='cprofile', interval=0.005,
+                 operations=None):
+        if mode not in MODES:
+            raise ValueError('unknown profile mode: %s' % mode)
+
+        # FUSE changes the working directory when it daemonizes
+        self.filename = path.abspath(filename)
+        self.mode = mode
+        self.interval = interval
+        self.operations = operations and frozenset(operations)
+
+        self.lock = threading.Lock()
+        self.running = None
+        self.profiles = []
+        self.local = threading.local()
+
+        # the shared profile and the calls using it
+        self.shared = None
+        self.calls = 0
+
+        # sampling state: stacks seen and the threads in a profiled call
+        self.samples = defaultdict(int)
+        self.active = {}
+        self.sampler = None
+
+    def _profile(self):
+        'Returns the profile of the calling thread'
+
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+
+        return profile
+
+    def wants(self, operation):
+        return not self.operations or operation in self.operations
+
+    def start(self, include_current=True):
+        '''
+        Starts profiling the whole run. Sampling includes every thread
+        (but the calling thread if ``include_current`` is not set) and
+        cProfile only the calling thread.
+        '''
+
+        if self.mode == 'cprofile':
+            self.running = self._profile()
+            self.running.enable()
+        else:
+            self.running = include_current or threading.current_thread()
+            self._start_sampler()
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            if self.running: self.running.disable()
+        elif self.sampler:
+            self.sampler, sampler = None, self.sampler
+            sampler.join()
+
+        self.running = None
+
+    def _enable(self):
+        '''
+        Enables the profile of a call and returns it, or ``None`` if another
+        profiler is active
+        '''
+
+        if not _SHARED_PROFILE:
+            profile = self._profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return None
+
+            return profile
+
+        with self.lock:
+            if self.shared is None:
+                self.shared = cProfile.Profile()
+                self.profiles.append(self.shared)
+
+            if not self.calls:
+                try:
+                    self.shared.enable()
+                except ValueError:
+                    return None
+
+            self.calls += 1
+            return self.shared
+
+    def _disable(self, profile):
+        if not _SHARED_PROFILE:
+            profile.disable()
+            return
+
+        with self.lock:
+            self.calls -= 1
+            if not self.calls: profile.disable()
+
+    def call(self, name, function, *args):
+        '''
+        Profiles a single call of ``function`` labelled ``name``, the call is
+        not profiled if another profiler is active
+        '''
+
+        if self.mode == 'cprofile':
+            profile = self._enable()
+            if profile is None: return function(*args)
+
+            try:
+                return function(*args)
+            finally:
+                self._disable(profile)
+
+        ident = threading.current_thread().ident
+        self.active[ident] = name
+        if not self.sampler: self._start_sampler()
+
+        try:
+            return function(*args)
+        finally:
+            self.active.pop(ident, None)
+
+    def _start_sampler(self):
+        with self.lock:
+            if self.sampler: return
+
+            self.sampler = threading.Thread(target=self._sample,
+                                            name='xzip-profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def _sample(self):
+        # the module globals are cleared when Python 2 exits before this
+        # daemon thread
+        current_frames, sleep = sys._current_frames, time.sleep
+        basename = path.basename
+
+        own = threading.current_thread().ident
+        excluded = (self.running.ident
+                    if isinstance(self.running, threading.Thread) else None)
+
+        while self.sampler:
+            sleep(self.interval)
+
+            for ident, frame in current_frames().items():
+                if ident in (own, excluded): continue
+
+                # outside of a whole run only the threads in a profiled call
+                # are sampled
+                name = self.active.get(ident)
+                if self.running is None and name is None: continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name,
+                                                 basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+
+                if name: stack.append(name)
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self):
+        'Writes the profile collected so far'
+
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+
+        if self.mode == 'cprofile':
+            stats = None
+            with self.lock:
+                profiles = list(self.profiles)
+
+            for profile in profiles:
+                # collecting the stats disables the profile
+                with self.lock:
+                    current = pstats.Stats(profile)
+                    if profile is self.running or \
+                            (profile is self.shared and self.calls):
+                        profile.enable()
+
+                if stats is None:
+                    stats = current
+                else:
+                    stats.add(current)
+
+            if stats is None: return
+            stats.dump_stats(tmp)
+
+        else:
+            with open(tmp, 'w') as output:
+                for stack, count in sorted(self.samples.items()):
+                    output.write('%s %d\n' % (stack, count))
+
+        os.rename(tmp, self.filename)
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        'Dumps the profile when the process receives ``signum``'
+
+        signal.signal(signum, lambda *_: self.dump())
+
+
+def add_arguments(parser, operations=False):
+    'Adds the profiling options to an ``ArgumentParser``'
+
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='profile the run and write the profile to FILE '
+                             'on exit and on SIGUSR2')
+
+    parser.add_argument('--profile-mode', choices=MODES, default='cprofile',
+                        help='cprofile writes pstats data, sample writes '
+                             'collapsed stacks with a lower overhead')
+
+    parser.add_argument('--profile-interval', metavar='SECONDS', type=float,
+                        default=0.005, help='sampling interval')
+
+    if operations:
+        parser.add_argument('--profile-ops', metavar='OPS', default=None,
+                            help='comma separated FUSE operations to '
+                                 'profile (default: all)')
+
+
+def from_args(args):
+    'Returns the ``Profiler`` requested by the options or ``None``'
+
+    if not args.profile: return
+
+    operations = getattr(args, 'profile_ops', None)
+    return Profiler(args.profile, args.profile_mode, args.profile_interval,
+                    operations and operations.split(','))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import copy
+import errno
+import os
+import threading
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from io import FileIO
+from os import path
+
+__all__ = ('BlobStore', 'DirectoryStore', 'CachedStore')
+
+CHUNK_SIZE = 2 ** 20
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # another process may have created it in the mean time
+        if not path.isdir(directory): raise
+
+
+def _file_chunks(file):
+    return iter(lambda: file.read(CHUNK_SIZE), b'')
+
+
+# declared through the metaclass so it works on Python 2 and 3
+class BlobStore(ABCMeta('BlobStore', (object,), {})):
+    '''
+    Stores the data files of exploded zips, named by the hex digest of their
+    contents. Missing data files raise ``IOError``/``OSError`` with
+    ``ENOENT``.
+    '''
+
+    @abstractmethod
+    def exists(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def size(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, name):
+        'Returns a seekable binary file with the contents of ``name``'
+
+        raise NotImplementedError
+
+    @abstractmethod
+    def put(self, name, chunks):
+        '''
+        Stores the byte strings ``chunks`` as ``name``, which is only visible
+        once complete
+        '''
+
+        raise NotImplementedError
+
+    def put_file(self, name, filename):
+        'Moves the complete local file ``filename`` into the store'
+
+        with open(filename, 'rb') as file:
+            self.put(name, _file_chunks(file))
+
+        os.remove(filename)
+
+    def local_path(self, name):
+        '''
+        Returns the path of ``name`` on the local file system or ``None`` if
+        it has to be read with ``get``
+        '''
+
+        return None
+
+
+class DirectoryStore(BlobStore):
+    '''
+    Data files in the directory ``root`` (the ``data`` directory of an
+    exploded tree) split in ``depth`` levels of subdirectories named by the
+    leading characters of the digests
+    '''
+
+    def __init__(self, root, depth=0):
+        self.root = root
+        self.depth = depth
+
+    def path(self, name):
+        return path.join(*([self.root] + list(name[:self.depth]) + [name]))
+
+    def exists(self, name):
+        return path.isfile(self.path(name))
+
+    def size(self, name):
+        return os.stat(self.path(name)).st_size
+
+    def get(self, name):
+        return FileIO(self.path(name), 'rb')
+
+    def put(self, name, chunks):
+        filename = self.path(name)
+        _makedirs(path.dirname(filename))
+
+        # write to a temporary file so a partial data file is never visible
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+
+            os.rename(tmp, filename)
+        except:
+            if path.exists(tmp): os.remove(tmp)
+            raise
+
+    def put_file(self, name, filename):
+        _makedirs(path.dirname(self.path(name)))
+
+        try:
+            os.rename(filename, self.path(name))
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            super(DirectoryStore, self).put_file(name, filename)
+
+    def local_path(self, name):
+        return self.path(name)
+
+
+class _Fetch(object):
+    'A data file being copied to the cache'
+
+    __slots__ = ('done', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class CachedStore(BlobStore):
+    '''
+    Reads the data files of the (slower) ``remote`` store through a cache of
+    at most ``size`` bytes in the local directory ``root``. The least
+    recently used data files are evicted first, and a data file missed by
+    several readers at once is only fetched once. Data files are written to
+    ``remote`` directly.
+    '''
+
+    def __init__(self, remote, root, size=2 ** 30, depth=0):
+        self.remote = remote
+        self.local = DirectoryStore(root, depth)
+        self.limit = size
+        self.lock = threading.Lock()
+        self.fetches = {}
+        self.counters = dict.fromkeys(('hits', 'misses', 'evictions',
+                                       'fetched_bytes', 'bytes'), 0)
+
+        # data files kept from a previous run, oldest access first
+        self.entries = OrderedDict()
+        found = []
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    os.remove(path.join(directory, filename))
+                    continue
+
+                stat = os.stat(path.join(directory, filename))
+                found.append((stat.st_atime, filename, stat.st_size))
+
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.counters['bytes'] += size
+
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        # called with the lock held, readers which opened an evicted data
+        # file keep reading it
+        counters = self.counters
+        while counters['bytes'] > self.limit and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            counters['bytes'] -= size
+            self.counters['evictions'] += 1
+
+            try:
+                os.remove(self.local.path(name))
+            except OSError:
+                pass
+
+    def _fetch(self, name, fetch):
+        'Copies ``name`` to the cache and returns it opened'
+
+        file = None
+        try:
+            with self.remote.get(name) as remote:
+                self.local.put(name, _file_chunks(remote))
+
+            # opened before it can be evicted
+            file = self.local.get(name)
+            size = os.fstat(file.fileno()).st_size
+        except (IOError, OSError) as e:
+            fetch.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.fetches[name]
+
+                if file is not None:
+                    self.entries[name] = size
+                    self.counters['bytes'] += size
+                    self.counters['fetched_bytes'] += size
+                    self._evict()
+
+            fetch.done.set()
+
+        return file
+
+    def exists(self, name):
+        return name in self.entries or self.remote.exists(name)
+
+    def size(self, name):
+        size = self.entries.get(name)
+        return self.remote.size(name) if size is None else size
+
+    def get(self, name):
+        while True:
+            with self.lock:
+                size = self.entries.pop(name, None)
+                if size is not None:
+                    # opened with the lock held so it is not evicted first
+                    try:
+                        file = self.local.get(name)
+                    except (IOError, OSError) as e:
+                        if e.errno != errno.ENOENT: raise
+                        self.counters['bytes'] -= size
+                    else:
+                        self.entries[name] = size
+                        self.counters['hits'] += 1
+                        return file
+
+                fetch = self.fetches.get(name)
+                owner = fetch is None
+                if owner:
+                    fetch = self.fetches[name] = _Fetch()
+                    self.counters['misses'] += 1
+
+            if owner: return self._fetch(name, fetch)
+
+            # fetched by another reader, and possibly evicted again since
+            fetch.done.wait()
+            if fetch.error: raise fetch.error
+
+    def put(self, name, chunks):
+        self.remote.put(name, chunks)
+
+    def put_file(self, name, filename):
+        self.remote.put_file(name, filename)
+
+    def share(self, remote):
+        '''
+        Returns a store reading ``remote`` through the same cache, the data
+        files are named by their contents so the stores can share them
+        '''
+
+        store = copy.copy(self)
+        store.remote = remote
+        return store
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), limit=self.limit)
+
+        return stats
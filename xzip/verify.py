@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import json
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+from argparse import ArgumentParser
+from binascii import b2a_hex
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+from os import path
+
+from xzip.explode import (CENTRAL_DIR, CHUNK_COUNT, DATA_DESCRIPTOR,
+                          DESCRIPTOR_LEN_MASK, INLINE_LENGTH, ITEM_CHUNKED,
+                          ITEM_INLINE, ITEM_RECOMPRESSED, JUMP_ITEM,
+                          LOCAL_HEADER, find_end_of_dir,
+                          get_digest, open_meta, read_chunks, read_meta,
+                          read_stream_header, recompress, recompression_size,
+                          unpack_recompression, zip64_info)
+from xzip.store import DirectoryStore
+
+__all__ = ('CHUNK_SIZE', 'RateLimiter', 'Checkpoint', 'iter_blobs',
+           'iter_archives', 'store_digests', 'verify_blob', 'verify_archive',
+           'parser')
+
+CHUNK_SIZE = 2 ** 20
+HEX_DIGEST = re.compile(r'^[0-9a-f]+$')
+
+
+class RateLimiter(object):
+    '''
+    Limits the number of bytes per second consumed by the calling process.
+
+    A ``rate`` of ``None`` (or ``0``) disables limiting.
+    '''
+
+    __slots__ = ('rate', 'start', 'consumed')
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.time()
+        self.consumed = 0
+
+    def consume(self, count):
+        if not self.rate: return
+
+        self.consumed += count
+        delay = self.start + float(self.consumed) / self.rate - time.time()
+        if delay > 0: time.sleep(delay)
+
+
+class Checkpoint(object):
+    '''
+    Persists the phase of a scrub (``blobs`` or ``archives``) and the last
+    blob and archive names which were completely verified so a scrub can be
+    interrupted and resumed in a later run. The progress is saved at most
+    every ``interval`` seconds (and by ``save``).
+    '''
+
+    def __init__(self, filename=None, interval=5.0):
+        self.filename = filename
+        self.interval = interval
+        self.saved = time.time()
+        self.state = {'phase': None, 'blobs': None, 'archives': None}
+
+        if filename and path.isfile(filename):
+            with open(filename) as checkpoint:
+                self.state.update(json.load(checkpoint))
+
+    def get(self, kind):
+        return self.state.get(kind)
+
+    def update(self, kind, name):
+        self.state[kind] = name
+        if time.time() - self.saved >= self.interval: self.save()
+
+    def finish(self, kind, following=None):
+        '''
+        Marks ``kind`` as completed. The next run goes on with the phase
+        ``following``, or starts the scrub from the top if there is none.
+        '''
+
+        if following:
+            self.state.update({kind: None, 'phase': following})
+        else:
+            self.state.update(phase=None, blobs=None, archives=None)
+
+        self.save()
+
+    def save(self):
+        self.saved = time.time()
+        if not self.filename: return
+
+        # write and rename so an interrupted save never loses the checkpoint
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as checkpoint:
+            json.dump(self.state, checkpoint)
+
+        os.rename(tmp, self.filename)
+
+
+def iter_blobs(base='.', depth=0, after=None):
+    '''
+    Yields the path of every blob in sorted order (the order is the same as
+    the order of the digests because the subdirectories are digest prefixes)
+    skipping names up to and including ``after`` and the temporary files of
+    data files being written.
+    '''
+
+    def walk(directory, level):
+        try:
+            entries = sorted(os.listdir(directory))
+        except OSError:
+            return
+
+        for entry in entries:
+            if level < depth:
+                # skip whole subdirectories which were already verified
+                if after and entry < after[level]: continue
+
+                for blob in walk(path.join(directory, entry), level + 1):
+                    yield blob
+
+            elif entry.endswith('.tmp'):
+                continue
+
+            elif not after or entry > after:
+                yield path.join(directory, entry)
+
+    return walk(path.join(base, 'data'), 0)
+
+
+def iter_archives(base='.', after=None):
+    'Yields the name of every exploded archive in sorted order'
+
+    for entry in sorted(os.listdir(path.join(base, 'meta'))):
+        if entry.endswith('.dir'):
+            name = entry[:-4]
+            if not after or name > after:
+                yield name
+
+
+def store_digests(base='.'):
+    'Returns the names of the digests used by the exploded archives'
+
+    digests = set()
+    for name in iter_archives(base):
+        try:
+            with open_meta(name, '.stream', base) as s:
+                digests.add(read_stream_header(s).digest.name)
+        except (IOError, OSError, ValueError, zlib.error):
+            # reported when the archive itself is verified
+            pass
+
+    return digests or set(['sha1'])
+
+
+def _limited(chunks, limiter):
+    for chunk in chunks:
+        limiter.consume(len(chunk))
+        yield chunk
+
+
+def verify_blob(filename, limiter=None, digests=('sha1',)):
+    '''
+    Re-hashes a blob with every digest in ``digests`` which has the length
+    of its name and returns a list of problems (an empty list means the blob
+    matches its name)
+    '''
+
+    limiter = limiter or RateLimiter()
+    name = path.basename(filename)
+    hashes = [digest.new() for digest in map(get_digest, digests)
+              if digest.size * 2 == len(name)]
+
+    if not HEX_DIGEST.match(name) or not hashes:
+        return ['unexpected file in data directory']
+
+    try:
+        with open(filename, 'rb') as blob:
+            for chunk in _limited(read_chunks(blob), limiter):
+                for hash in hashes:
+                    hash.update(chunk)
+    except (IOError, OSError) as e:
+        return ['unreadable: %s' % e]
+
+    actual = [hash.hexdigest() for hash in hashes]
+    if name not in actual:
+        return ['digest mismatch (%s)' % ', '.join(actual)]
+
+    return []
+
+
+def _read_blobs(store, names, limiter):
+    for name in names:
+        with store.get(name) as blob:
+            for chunk in _limited(read_chunks(blob), limiter):
+                yield chunk
+
+
+def _crc(chunks, compression, hash=None):
+    '''
+    Returns the CRC32 of the uncompressed byte strings ``chunks`` (the data
+    of a member) or None if not supported, ``hash`` is updated with them
+    '''
+
+    if compression == 0:
+        decompress = None
+    elif compression == 8:
+        decompress = zlib.decompressobj(-15).decompress
+    elif hash is None:
+        return None
+    else:
+        decompress = False
+
+    crc = 0
+    for chunk in chunks:
+        if hash is not None: hash.update(chunk)
+        if decompress is False: continue
+
+        if decompress: chunk = decompress(chunk)
+        crc = zlib.crc32(chunk, crc)
+
+    return None if decompress is False else crc & 0xffffffff
+
+
+def _recompressed_digest(store, name, recompression, digest, limiter):
+    'Returns the digest and size of a regenerated recompressed member'
+
+    hash = digest.new()
+    size = 0
+    with store.get(name) as blob:
+        for chunk in recompress(_limited(read_chunks(blob), limiter),
+                                recompression[:3], recompression.fingerprint):
+            hash.update(chunk)
+            size += len(chunk)
+
+    return hash.digest(), size
+
+
+def verify_archive(name, base='.', depth=0, crc=True, limiter=None,
+                   store=None):
+    '''
+    Checks that the meta triple of the exploded archive ``name`` is
+    consistent with the data files in ``store`` (by default the ``data``
+    directory of ``base``) and rebuilds an archive of the original length
+    (and CRCs if ``crc`` is set). Returns a list of problems.
+    '''
+
+    limiter = limiter or RateLimiter()
+    if store is None: store = DirectoryStore(path.join(base, 'data'), depth)
+    prefix = path.join(base, 'meta', name)
+    problems = []
+
+    try:
+        with open(prefix + '.jump', 'rb') as jump:
+            jumps = [JUMP_ITEM.unpack(item) for item in
+                     iter(lambda: jump.read(JUMP_ITEM.size), b'')]
+
+        # compact meta files are decoded (and checked against their CRC)
+        stream_data = read_meta(name, '.stream', base)
+        stream = BytesIO(stream_data)
+        stream_format = read_stream_header(stream)
+        digest_format = stream_format.digest
+        stream_item = digest_format.stream_item
+        stream_start = stream.tell()
+
+        dir_data = read_meta(name, '.dir', base)
+    except (IOError, OSError, ValueError, zlib.error) as e:
+        return ['unreadable meta data: %s' % e]
+
+    if not jumps:
+        return ['empty jump file']
+
+    (filesize, directory_offset), jumps = jumps[0], jumps[1:]
+    if directory_offset + len(dir_data) != filesize:
+        problems.append('directory size %d does not match file size %d' %
+                        (len(dir_data), filesize - directory_offset))
+
+    # walk the stream items and the central directory side by side
+    dir_offset = 0
+    stream_end = stream_start
+    expected_offset = 0
+    for index, (zip_offset, stream_offset) in enumerate(jumps):
+        where = 'entry %d' % index
+
+        if zip_offset != expected_offset:
+            problems.append('%s: starts at %d, expected %d' %
+                            (where, zip_offset, expected_offset))
+
+        try:
+            info = CENTRAL_DIR.unpack(
+                    dir_data[dir_offset:dir_offset + CENTRAL_DIR.size])
+            header = stream_item.unpack(
+                    stream_data[stream_offset:stream_offset +
+                                stream_item.size])
+        except struct.error as e:
+            problems.append('%s: truncated meta data (%s)' % (where, e))
+            return problems
+
+        extra_offset = dir_offset + CENTRAL_DIR.size + info.filename_len
+        dir_offset = extra_offset + info.extra_field_len + info.comment_len
+        info = zip64_info(info, dir_data[extra_offset:extra_offset +
+                                         info.extra_field_len])
+
+        if info.signature != CENTRAL_DIR.marker:
+            problems.append('%s: bad central directory signature' % where)
+        if header[0] != LOCAL_HEADER.marker:
+            problems.append('%s: bad local header signature' % where)
+        if info.offset != zip_offset:
+            problems.append('%s: central directory offset %d does not match '
+                            'jump offset %d' % (where, info.offset,
+                                                zip_offset))
+
+        filename_len, extra_field_len, item_flags, item_digest = header[-4:]
+        descriptor_len = item_flags & DESCRIPTOR_LEN_MASK
+        descriptor_offset = (stream_offset + stream_item.size +
+                             filename_len + extra_field_len)
+        descriptor = stream_data[descriptor_offset:
+                                 descriptor_offset + descriptor_len]
+        item_end = descriptor_offset + descriptor_len
+
+        recompression = None
+        if item_flags & ITEM_RECOMPRESSED:
+            try:
+                recompression = unpack_recompression(stream_format,
+                        stream_data[item_end:item_end +
+                                    recompression_size(stream_format)])
+            except struct.error as e:
+                problems.append('%s: truncated meta data (%s)' % (where, e))
+                return problems
+
+            item_end += recompression_size(stream_format)
+            if recompression.compressed_size != info.compressed_size:
+                problems.append('%s: recompressed size %d does not match %d' %
+                                (where, recompression.compressed_size,
+                                 info.compressed_size))
+
+        # recompressed members are stored in the data file of their
+        # canonical deflate stream, chunked members in one per chunk and
+        # inline members in the stream item
+        inline = None
+        if item_flags & ITEM_INLINE:
+            try:
+                length, = INLINE_LENGTH.unpack(stream_data[
+                        item_end:item_end + INLINE_LENGTH.size])
+            except struct.error as e:
+                problems.append('%s: truncated meta data (%s)' % (where, e))
+                return problems
+
+            item_end += INLINE_LENGTH.size
+            inline = stream_data[item_end:item_end + length]
+            item_end += length
+            blobs = []
+
+            if len(inline) != info.compressed_size:
+                problems.append('%s: inline data is %d bytes, expected %d' %
+                                (where, len(inline), info.compressed_size))
+
+        elif item_flags & ITEM_CHUNKED:
+            try:
+                count, = CHUNK_COUNT.unpack(stream_data[
+                        item_end:item_end + CHUNK_COUNT.size])
+                item_end += CHUNK_COUNT.size
+                chunk = digest_format.chunk
+                blobs = [chunk.unpack(stream_data[
+                            item_end + i * chunk.size:
+                            item_end + (i + 1) * chunk.size])
+                         for i in range(count)]
+            except struct.error as e:
+                problems.append('%s: truncated meta data (%s)' % (where, e))
+                return problems
+
+            item_end += count * chunk.size
+            if sum(length for length, _ in blobs) != info.compressed_size:
+                problems.append('%s: chunks do not add up to %d bytes' %
+                                (where, info.compressed_size))
+        else:
+            blobs = [(info.compressed_size, recompression.digest
+                      if recompression else item_digest)]
+
+        found = True
+        for length, digest in blobs:
+            digest = b2a_hex(digest).decode('ascii')
+
+            try:
+                blob_len = store.size(digest)
+            except (IOError, OSError):
+                problems.append('%s: missing blob %s' % (where, digest))
+                found = False
+                continue
+
+            if blob_len != length and not recompression:
+                problems.append('%s: blob %s is %d bytes, expected %d' %
+                                (where, digest, blob_len, length))
+
+        if descriptor:
+            # the marker is optional (the CRC comes first in both the 32-bit
+            # and the zip64 descriptors)
+            if descriptor.startswith(DATA_DESCRIPTOR.marker):
+                descriptor = descriptor[len(DATA_DESCRIPTOR.marker):]
+
+            if DATA_DESCRIPTOR.unpack(descriptor[:DATA_DESCRIPTOR.size]) \
+                    .crc != info.crc:
+                problems.append('%s: data descriptor CRC does not match the '
+                                'central directory' % where)
+
+        # inline members are not covered by the data files, they are
+        # always checked against their digest
+        if inline is not None:
+            hash = digest_format.new()
+            try:
+                actual = _crc([inline], info.compression if crc else None,
+                              hash)
+            except zlib.error as e:
+                problems.append('%s: unable to decompress inline data: %s' %
+                                (where, e))
+            else:
+                if actual is not None and actual != info.crc:
+                    problems.append('%s: CRC %08x does not match %08x' %
+                                    (where, actual, info.crc))
+
+                if hash.digest() != item_digest:
+                    problems.append('%s: inline data does not match the '
+                                    'member digest' % where)
+
+        # chunked members are also checked against their digest
+        elif crc and found:
+            hash = digest_format.new() if len(blobs) > 1 else None
+            try:
+                actual = _crc(_read_blobs(store,
+                                          [b2a_hex(name).decode('ascii')
+                                           for _, name in blobs], limiter),
+                              info.compression, hash)
+            except (IOError, OSError, zlib.error) as e:
+                problems.append('%s: unable to decompress blob %s: %s' %
+                                (where, digest, e))
+            else:
+                if actual is not None and actual != info.crc:
+                    problems.append('%s: CRC %08x does not match %08x' %
+                                    (where, actual, info.crc))
+
+                if hash and hash.digest() != item_digest:
+                    problems.append('%s: chunks do not match the member '
+                                    'digest' % where)
+
+        if crc and recompression and found:
+            try:
+                actual, size = _recompressed_digest(store, digest,
+                                                    recompression,
+                                                    digest_format, limiter)
+            except (IOError, OSError, ValueError, zlib.error) as e:
+                problems.append('%s: unable to regenerate blob %s: %s' %
+                                (where, digest, e))
+            else:
+                if actual != item_digest or size != info.compressed_size:
+                    problems.append('%s: blob %s does not regenerate the '
+                                    'original member' % (where, digest))
+
+        stream_end = item_end
+        expected_offset = (zip_offset + LOCAL_HEADER.size + filename_len +
+                           extra_field_len + info.compressed_size +
+                           descriptor_len)
+
+    if expected_offset != directory_offset:
+        problems.append('members end at %d, central directory starts at %d' %
+                        (expected_offset, directory_offset))
+
+    if len(stream_data) != stream_end:
+        problems.append('trailing data in stream file')
+
+    eoa = find_end_of_dir(BytesIO(dir_data), directory_offset)
+    if eoa is None:
+        problems.append('missing end of central directory record')
+    elif eoa.total_entries != len(jumps):
+        problems.append('end of central directory entry count does not '
+                        'match the jump file')
+
+    return problems
+
+
+
+
+_limiter = None
+_digests = None
+
+def _init_worker(rate, digests):
+    global _limiter, _digests
+    _limiter = RateLimiter(rate)
+    _digests = digests
+
+def _verify_blob(filename):
+    return path.basename(filename), verify_blob(filename, _limiter, _digests)
+
+def _verify_archive(args):
+    name, base, depth, crc = args
+    return name, verify_archive(name, base, depth, crc, _limiter)
+
+
+def parse_size(value):
+    'Parses a byte count with an optional K, M, G or T suffix'
+
+    units = 'KMGT'
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+
+    return int(value)
+
+
+parser = ArgumentParser(description='Verifies the blobs and meta data of '
+                                    'exploded zip files.')
+
+parser.add_argument('-d', '--depth', type=int, default=0,
+                    help='data subdirectory depth')
+
+parser.add_argument('-j', '--jobs', type=int, default=None,
+                    help='number of worker processes (default: CPU count)')
+
+parser.add_argument('-r', '--rate', type=parse_size, default=None,
+                    metavar='BYTES', help='limit the total read rate in '
+                                          'bytes per second (K, M, G suffixes '
+                                          'are accepted)')
+
+parser.add_argument('-c', '--checkpoint', metavar='FILE', default=None,
+                    help='save progress to FILE and resume from it')
+
+parser.add_argument('-t', '--time-limit', type=float, default=None,
+                    metavar='SECONDS', help='stop after SECONDS (to be '
+                                            'resumed with --checkpoint)')
+
+parser.add_argument('--skip-blobs', action='store_true', default=False,
+                    help='do not re-hash the data directory')
+
+parser.add_argument('--skip-meta', action='store_true', default=False,
+                    help='do not check the meta data')
+
+parser.add_argument('--no-crc', dest='crc', action='store_false',
+                    default=True, help='do not decompress blobs to check '
+                                       'the CRCs of the original zips')
+
+parser.add_argument('directory', nargs='?', default='.',
+                    help='base of the exploded files')
+
+
+def _scrub(pool, kind, function, items, checkpoint, deadline,
+           following=None):
+    '''
+    Runs ``function`` over ``items`` and returns the number of problems and
+    whether ``kind`` was completed (see ``Checkpoint.finish``)
+    '''
+
+    problems = 0
+    for name, errors in pool.imap(function, items):
+        for error in errors:
+            print('%s %s: %s' % (kind[:-1], name, error))
+            problems += 1
+
+        # results are returned in order so everything up to name is done
+        checkpoint.update(kind, name)
+
+        if deadline and time.time() >= deadline:
+            checkpoint.save()
+            return problems, False
+
+    checkpoint.finish(kind, following)
+    return problems, True
+
+
+def main():
+    args = parser.parse_args()
+
+    jobs = args.jobs or None
+    # every worker gets an equal share of the rate
+    rate = args.rate and args.rate / (jobs or cpu_count())
+    deadline = args.time_limit and time.time() + args.time_limit
+    checkpoint = Checkpoint(args.checkpoint)
+
+    digests = sorted(store_digests(args.directory))
+    pool = Pool(jobs, _init_worker, (rate, digests))
+    problems = 0
+    complete = True
+
+    # a run interrupted while checking the archives goes on with them, the
+    # blobs are only scrubbed again once the archives are done
+    phase = checkpoint.get('phase') or 'blobs'
+
+    try:
+        if not args.skip_blobs and (phase == 'blobs' or args.skip_meta):
+            after = checkpoint.get('blobs')
+            found, complete = _scrub(pool, 'blobs', _verify_blob,
+                                     iter_blobs(args.directory, args.depth,
+                                                after),
+                                     checkpoint, deadline,
+                                     None if args.skip_meta else 'archives')
+            problems += found
+
+        if complete and not args.skip_meta:
+            after = checkpoint.get('archives')
+            items = ((name, args.directory, args.depth, args.crc)
+                     for name in iter_archives(args.directory, after))
+
+            found, complete = _scrub(pool, 'archives', _verify_archive,
+                                     items, checkpoint, deadline)
+            problems += found
+    finally:
+        pool.terminate()
+        pool.join()
+
+        # keep the progress made since the last save
+        checkpoint.save()
+
+    if not complete:
+        sys.stderr.write('time limit reached, resume with --checkpoint\n')
+
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
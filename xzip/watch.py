@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import struct
+
+from collections import deque
+from fnmatch import fnmatch
+from multiprocessing import Pool
+from os import path
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+__all__ = ('IN_CLOSE_WRITE', 'IN_MOVED_TO', 'IN_Q_OVERFLOW', 'Inotify',
+           'watch')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# wd, mask, cookie and length of the name following the event
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    'Watches directories with the inotify API of the C library (Linux only)'
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, directory, mask):
+        if not isinstance(directory, bytes):
+            directory = directory.encode('utf-8')
+
+        wd = self.libc.inotify_add_watch(self.fd, directory, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'unable to watch %s' %
+                                              directory.decode('utf-8'))
+
+        return wd
+
+    def read(self, timeout=None):
+        '''
+        Returns the (wd, mask, cookie, name) of the pending events, waiting
+        at most ``timeout`` seconds for one
+        '''
+
+        if not select.select([self.fd], [], [], timeout)[0]: return []
+
+        try:
+            data = os.read(self.fd, 2 ** 16)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR): return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+
+            name = data[offset:offset + length].rstrip(b'\0')
+            events.append((wd, mask, cookie, name.decode('utf-8', 'replace')))
+            offset += length
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _init_worker():
+    # the watching process decides when to stop and lets the workers
+    # complete the files they are processing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _call(args):
+    function, filename, extra = args
+
+    try:
+        return filename, function(filename, *extra), None
+    except Exception as e:
+        return filename, None, str(e) or e.__class__.__name__
+
+
+def watch(directory, function, args=(), pattern='*.zip', jobs=1, queue=8,
+          done=None):
+    '''
+    Yields ``(filename, result, error)`` for every file matching ``pattern``
+    written to ``directory`` (closed after writing or moved in) once
+    ``function(filename, *args)`` processed it in a pool of ``jobs``
+    processes. The files already in the directory are processed first unless
+    ``done(filename)`` is true.
+
+    At most ``queue`` files are waiting or being processed: when the queue is
+    full the events are left to the kernel, and when the kernel drops events
+    the directory is scanned again.
+    '''
+
+    def scan():
+        return [path.join(directory, entry)
+                for entry in sorted(os.listdir(directory))
+                if fnmatch(entry, pattern) and
+                not (done and done(path.join(directory, entry)))]
+
+    inotify = Inotify()
+    inotify.add_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    pool = Pool(jobs, _init_worker)
+    results = Queue()
+    waiting = deque(scan())
+    pending = set()
+    stale = set()
+
+    def add(filename):
+        if filename not in waiting: waiting.append(filename)
+
+    def finish(result):
+        pending.discard(result[0])
+
+        # written again while it was being processed
+        if result[0] in stale:
+            stale.discard(result[0])
+            add(result[0])
+
+        return result
+
+    try:
+        while True:
+            while waiting and len(pending) < queue:
+                filename = waiting.popleft()
+                if filename in pending:
+                    stale.add(filename)
+                    continue
+
+                pending.add(filename)
+                pool.apply_async(_call, ((function, filename, args),),
+                                 callback=results.put)
+
+            if waiting or len(pending) >= queue:
+                # back pressure, the time out keeps signals working
+                try:
+                    yield finish(results.get(timeout=1))
+                except Empty:
+                    pass
+
+                continue
+
+            for _, mask, _, name in inotify.read(timeout=1):
+                if mask & IN_Q_OVERFLOW:
+                    for filename in scan():
+                        if filename not in pending: add(filename)
+                elif fnmatch(name, pattern):
+                    add(path.join(directory, name))
+
+            while True:
+                try:
+                    result = results.get_nowait()
+                except Empty:
+                    break
+
+                yield finish(result)
+    finally:
+        inotify.close()
+
+        # let the files being processed complete
+        pool.close()
+        pool.join()